@@ -1,20 +1,57 @@
+import os
+
 from flask import Flask, redirect, url_for
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
+from app.assets import StaticAssets
+from app.compression import Compress
+from app.ratelimit import RateLimiter
+from app.events import Events
+from app.profiling import Profiler
+from app.routing import RoutingSession, init_replica
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 migrate = Migrate()
+assets = StaticAssets()
+compress = Compress()
+limiter = RateLimiter()
+events = Events()
+profiler = Profiler()
 
 def create_app():
     app = Flask(__name__, template_folder='templates')
-    app.config['SECRET_KEY'] = '21f3003252'
+    # Rotate keys by moving the old one to SECRET_KEY_FALLBACKS (comma separated) for a while
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', '21f3003252')
+    app.config['SECRET_KEY_FALLBACKS'] = [key for key in os.environ.get('SECRET_KEY_FALLBACKS', '').split(',') if key]
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
+    # Number of reverse proxies in front of the app. Their X-Forwarded-For/-Proto headers are
+    # trusted only when this is set, so rate limits see each client's address and not the proxy's
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'],
+                                x_proto=app.config['TRUSTED_PROXIES'])
 
     db.init_app(app)
+    init_replica(app, db)
     login_manager.init_app(app)
     migrate.init_app(app, db)
+    assets.init_app(app)
+    compress.init_app(app)
+    limiter.init_app(app)
+    events.init_app(app)
+    profiler.init_app(app)
+
+    from app.transaction import init_statement_counter
+    from app.audit import AuditWriter
+    from app.sessions import ServerSessions
+    from app.cache import ResponseCache
+    init_statement_counter(app)
+    AuditWriter(app)
+    ServerSessions(app)
+    ResponseCache(app)
 
     # Define the default login view for the LoginManager
     login_manager.login_view = 'auth.login'
@@ -24,12 +61,28 @@ def create_app():
     from app.views.sponsor import sponsor_bp
     from app.views.influencer import influencer_bp
     from app.views.auth import auth_bp
+    from app.views.events import events_bp
 
     # Register blueprints
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(admin_bp, url_prefix='/admin')
     app.register_blueprint(sponsor_bp, url_prefix='/sponsor')
     app.register_blueprint(influencer_bp, url_prefix='/influencer')
+    app.register_blueprint(events_bp, url_prefix='/events')
+
+    # Maintenance commands (run with "flask --app run.py <group> <command>")
+    from app.archive import archive_cli
+    from app.recommendations import recommendations_cli
+    from app.sessions import sessions_cli
+    from app.rebuild import rebuild_cli
+    from app.ledger import ledger_cli
+    from app.lifecycle import lifecycle_cli
+    app.cli.add_command(archive_cli)
+    app.cli.add_command(recommendations_cli)
+    app.cli.add_command(sessions_cli)
+    app.cli.add_command(rebuild_cli)
+    app.cli.add_command(ledger_cli)
+    app.cli.add_command(lifecycle_cli)
 
     # Default route to redirect to login
     @app.route('/')
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import delete, literal, select
+
+from app import db
+from app.audit import record_bulk_change
+from app.models import Campaign, AdRequest, ArchivedCampaign, ArchivedAdRequest, CampaignRecommendation
+
+archive_cli = AppGroup('archive', help='Move finished campaigns out of the live tables.')
+
+
+def _copy_rows(source, target, where, archived_at):
+    # INSERT INTO archive (...) SELECT ... FROM live WHERE ..., one statement per batch
+    columns = [c.name for c in source.__table__.columns if c.name in target.__table__.columns]
+    rows = select(*[source.__table__.c[name] for name in columns], literal(archived_at)).where(where)
+    db.session.execute(target.__table__.insert().from_select(columns + ['archived_at'], rows))
+
+
+def archive_campaigns(campaign_ids, archived_at=None):
+    """Move the given campaigns and their ad requests to the archive tables.
+
+    Runs in the current transaction; the caller commits.
+    """
+    if not campaign_ids:
+        return 0
+    archived_at = archived_at or datetime.utcnow()
+
+    _copy_rows(Campaign, ArchivedCampaign, Campaign.id.in_(campaign_ids), archived_at)
+    _copy_rows(AdRequest, ArchivedAdRequest, AdRequest.campaign_id.in_(campaign_ids), archived_at)
+    # Core DELETEs bypass the audit listeners, so the deleted ids are audited from RETURNING
+    ad_request_ids = db.session.scalars(
+        delete(AdRequest).where(AdRequest.campaign_id.in_(campaign_ids)).returning(AdRequest.id)).all()
+    db.session.execute(delete(CampaignRecommendation).where(CampaignRecommendation.campaign_id.in_(campaign_ids)))
+    deleted_ids = db.session.scalars(
+        delete(Campaign).where(Campaign.id.in_(campaign_ids)).returning(Campaign.id)).all()
+    for ad_request_id in ad_request_ids:
+        record_bulk_change(db.session, AdRequest, ad_request_id, 'delete')
+    for campaign_id in deleted_ids:
+        record_bulk_change(db.session, Campaign, campaign_id, 'delete')
+    return len(deleted_ids)
+
+
+def archive_expired_campaigns(older_than_days=30, batch_size=200, now=None):
+    """Archive campaigns whose end date passed more than `older_than_days` ago.
+
+    Each batch is committed on its own so SQLite's write lock is only held briefly.
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(days=older_than_days)
+    total = 0
+    while True:
+        campaign_ids = db.session.scalars(
+            select(Campaign.id).where(Campaign.end_date < cutoff).order_by(Campaign.id).limit(batch_size)
+        ).all()
+        if not campaign_ids:
+            break
+        try:
+            total += archive_campaigns(campaign_ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return total
+
+
+@archive_cli.command('run')
+@click.option('--older-than-days', default=30, show_default=True,
+              help='Only archive campaigns that ended at least this many days ago.')
+@click.option('--batch-size', default=200, show_default=True, help='Campaigns moved per transaction.')
+def run_command(older_than_days, batch_size):
+    """Archive expired campaigns. Safe to run from cron."""
+    total = archive_expired_campaigns(older_than_days, batch_size)
+    click.echo(f'archived {total} campaign(s)')
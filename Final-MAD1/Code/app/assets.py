@@ -0,0 +1,131 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip variants are always available
+    brotli = None
+
+# Precompressed variants, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+ONE_YEAR = 31536000
+
+assets_cli = AppGroup('assets', help='Build and inspect fingerprinted static assets.')
+
+
+class StaticAssets:
+    """Serves files in the static folder under content-hashed names."""
+
+    def __init__(self, app=None):
+        self.static_folder = None
+        self.manifest = {}  # 'css/style.css' -> 'css/style.1a2b3c4d.css'
+        self.sources = {}   # reverse lookup of the manifest
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STATIC_FINGERPRINT', True)
+        app.config.setdefault('STATIC_HASH_LENGTH', 8)
+        app.extensions['static_assets'] = self
+        self.static_folder = app.static_folder
+
+        if app.config['STATIC_FINGERPRINT']:
+            self.build_manifest(app.config['STATIC_HASH_LENGTH'])
+            # Rewrite url_for('static', filename=...) to the fingerprinted name
+            app.url_defaults(self.fingerprint_url)
+
+        app.view_functions['static'] = self.send_static
+        app.cli.add_command(assets_cli)
+
+    def _walk(self):
+        for root, _, files in os.walk(self.static_folder):
+            for name in files:
+                if name.endswith(('.gz', '.br')):
+                    continue
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, self.static_folder).replace(os.sep, '/'), path
+
+    def build_manifest(self, hash_length=8):
+        self.manifest = {}
+        for filename, path in self._walk():
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:hash_length]
+            stem, ext = os.path.splitext(filename)
+            self.manifest[filename] = f'{stem}.{digest}{ext}'
+        self.sources = {hashed: source for source, hashed in self.manifest.items()}
+
+    def fingerprint_url(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = self.manifest.get(values['filename'], values['filename'])
+
+    def compress_all(self, level=9):
+        written = []
+        for filename, path in self._walk():
+            if not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.gz', 'wb') as f:
+                # mtime=0 keeps the output byte-identical between builds
+                f.write(gzip.compress(data, compresslevel=level, mtime=0))
+            written.append(filename + '.gz')
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data))
+                written.append(filename + '.br')
+        return written
+
+    def _variant_is_fresh(self, source, suffix):
+        # A variant left over from an older build must not shadow the current file
+        path = os.path.join(self.static_folder, source)
+        try:
+            return os.path.getmtime(path + suffix) >= os.path.getmtime(path)
+        except OSError:
+            return False
+
+    def send_static(self, filename):
+        source = self.sources.get(filename)
+        if source is None:
+            # Not a fingerprinted name, serve it the way Flask normally would
+            return send_from_directory(self.static_folder, filename)
+
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if request.accept_encodings[encoding] and self._variant_is_fresh(source, suffix):
+                mimetype, _ = mimetypes.guess_type(source)
+                response = send_from_directory(self.static_folder, source + suffix,
+                                               mimetype=mimetype, max_age=ONE_YEAR)
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = send_from_directory(self.static_folder, source, max_age=ONE_YEAR)
+
+        # The name changes whenever the content does, so the file never has to be revalidated
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+@assets_cli.command('compress')
+@click.option('--level', default=9, show_default=True, help='gzip compression level.')
+def compress_command(level):
+    """Write .gz (and .br, if brotli is installed) next to each static file."""
+    assets = current_app.extensions['static_assets']
+    for filename in assets.compress_all(level):
+        click.echo(f'wrote {filename}')
+
+
+@assets_cli.command('manifest')
+def manifest_command():
+    """List the fingerprinted name of every static file."""
+    assets = current_app.extensions['static_assets']
+    for source, hashed in sorted(assets.manifest.items()):
+        click.echo(f'{source} -> {hashed}')
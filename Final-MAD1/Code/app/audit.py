@@ -0,0 +1,193 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, g, has_app_context, has_request_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import AdRequest, AuditLog, Campaign, User
+
+logger = logging.getLogger(__name__)
+
+# Model -> audited attributes
+TRACKED = {
+    User: ('flagged',),
+    Campaign: ('name', 'description', 'start_date', 'end_date', 'budget', 'visibility', 'goals', 'flagged',
+               'closed_at'),
+    AdRequest: ('status', 'payment_amount'),
+}
+PENDING_KEY = 'audit_pending'
+
+
+def _serialize(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return str(value)
+
+
+def _actor_id():
+    # Never touch current_user here: loading it could run a query in the middle of a flush
+    if not has_request_context():
+        return None
+    user = g.get('_login_user')
+    if user is None or not getattr(user, 'is_authenticated', False):
+        return None
+    identity = inspect(user).identity
+    return identity[0] if identity else None
+
+
+def _entry(action, obj_or_model, entity_id, field=None, old=None, new=None):
+    model = obj_or_model if isinstance(obj_or_model, type) else type(obj_or_model)
+    return {
+        'created_at': datetime.utcnow(),
+        'actor_id': _actor_id(),
+        'action': action,
+        'entity': model.__tablename__,
+        'entity_id': entity_id,
+        'field': field,
+        'old_value': _serialize(old),
+        'new_value': _serialize(new),
+    }
+
+
+def _pending(session):
+    return session.info.setdefault(PENDING_KEY, [])
+
+
+def record_bulk_change(session, model, ident, action, values=None):
+    """Record a change made with a Core UPDATE/DELETE, which bypasses the flush events.
+
+    The previous values are not known without an extra query, so they are left empty.
+    """
+    if model not in TRACKED:
+        return
+    entries = _pending(session)
+    if action == 'delete':
+        entries.append(_entry('delete', model, ident))
+        return
+    for field, value in (values or {}).items():
+        if field in TRACKED[model]:
+            entries.append(_entry('update', model, ident, field, None, value))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, flush_context):
+    # new/dirty/deleted and attribute history still describe the flush that just ran;
+    # identity keys of new objects are not assigned yet, but their primary keys are
+    entries = _pending(session)
+    for obj in session.new:
+        fields = TRACKED.get(type(obj))
+        if fields:
+            for field in fields:
+                value = getattr(obj, field)
+                if value is not None:
+                    entries.append(_entry('insert', obj, obj.id, field, None, value))
+    for obj in session.dirty:
+        fields = TRACKED.get(type(obj))
+        if not fields:
+            continue
+        state = inspect(obj)
+        for field in fields:
+            history = state.attrs[field].history
+            if history.added:
+                old = history.deleted[0] if history.deleted else None
+                entries.append(_entry('update', obj, obj.id, field, old, history.added[0]))
+    for obj in session.deleted:
+        if type(obj) in TRACKED:
+            entries.append(_entry('delete', obj, obj.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _hand_over(session):
+    entries = session.info.pop(PENDING_KEY, None)
+    if entries and has_app_context():
+        current_app.extensions['audit'].submit(entries)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+class AuditWriter:
+    """Writes audit entries from a background thread, in batches, off the request path."""
+
+    def __init__(self, app=None):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.engine = None
+        self.log_file = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AUDIT_ASYNC', True)
+        app.config.setdefault('AUDIT_BATCH_SIZE', 200)
+        app.config.setdefault('AUDIT_FLUSH_INTERVAL', 1.0)  # seconds
+        app.config.setdefault('AUDIT_LOG_FILE', None)       # optional JSON-lines copy
+        app.extensions['audit'] = self
+        self.app = app
+        self.log_file = app.config['AUDIT_LOG_FILE']
+        atexit.register(self.stop)
+
+    def submit(self, entries):
+        if not self.app.config['AUDIT_ASYNC']:
+            self.write(entries)
+            return
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self.thread.start()
+        for entry in entries:
+            self.queue.put(entry)
+
+    def write(self, entries):
+        if self.engine is None:
+            with self.app.app_context():
+                self.engine = db.engine
+        # A plain connection, outside the ORM session, so writing is never audited itself
+        with self.engine.begin() as connection:
+            connection.execute(AuditLog.__table__.insert(), entries)
+        if self.log_file:
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, default=_serialize) + '\n')
+
+    def _run(self):
+        batch_size = self.app.config['AUDIT_BATCH_SIZE']
+        interval = self.app.config['AUDIT_FLUSH_INTERVAL']
+        batch = []
+        deadline = None  # a batch is written at most `interval` seconds after its first entry
+        stopping = False
+        while not stopping:
+            timeout = interval if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = False
+            if entry is None:
+                stopping = True
+            elif entry:
+                batch.append(entry)
+                deadline = deadline or time.monotonic() + interval
+
+            if batch and (stopping or len(batch) >= batch_size or time.monotonic() >= deadline):
+                try:
+                    self.write(batch)
+                    batch, deadline = [], None
+                except Exception:
+                    # Keep the batch and retry later, e.g. if the database was locked
+                    logger.exception('Could not write %d audit entries', len(batch))
+                    deadline = time.monotonic() + interval
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=10)
@@ -0,0 +1,274 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.models import InfluencerProfile, User
+
+PENDING_KEY = 'response_cache_pending'
+
+
+class MemoryStore:
+    """Cached responses in this process, least recently used evicted once `max_bytes` is reached."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires, mimetype, body, gzipped)
+        self.size = 0
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.size += len(entry[2]) + len(entry[3])
+            while self.size > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= len(entry[2]) + len(entry[3])
+
+    def generation(self, tag):
+        return self.generations.get(tag, 0)
+
+    def bump(self, tag):
+        # A timestamp rather than a counter, so concurrent bumps never need a read-modify-write
+        self.generations[tag] = time.time_ns()
+
+
+class FileStore:
+    """Cached responses as files in a directory, shared by every worker on the machine.
+
+    Invalidations are files too, so a change committed by one worker is seen by all.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, 'generations'), exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts[:-1], hashlib.sha1(parts[-1].encode('utf-8')).hexdigest())
+
+    def _write(self, path, data):
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)  # readers see the old file or the new one, never half of one
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read(meta['length'])
+                gzipped = f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        if meta['expires'] <= time.time():
+            return None
+        os.utime(path)  # the modification time doubles as the LRU clock
+        return meta['expires'], meta['mimetype'], body, gzipped
+
+    def set(self, key, entry):
+        expires, mimetype, body, gzipped = entry
+        meta = json.dumps({'expires': expires, 'mimetype': mimetype, 'length': len(body)}).encode('utf-8')
+        self._write(self._path(key), meta + b'\n' + body + gzipped)
+        self.size += len(meta) + len(body) + len(gzipped) + 1
+        if self.size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        files = sorted((entry for entry in os.scandir(self.directory) if entry.is_file()),
+                       key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if self.size <= self.max_bytes * 0.8:  # leave headroom so eviction doesn't run on every set
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except OSError:
+                pass  # another worker got there first
+
+    def generation(self, tag):
+        try:
+            with open(self._path('generations', tag), 'rb') as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def bump(self, tag):
+        self._write(self._path('generations', tag), str(time.time_ns()).encode('ascii'))
+
+
+class ResponseCache:
+    """Shared cache of pages that look the same to every visitor.
+
+    Entries are keyed on the URL plus the current generation of each tag the
+    page depends on; invalidating a tag moves its generation on, so stale
+    entries are simply never looked up again and age out of the LRU.
+    """
+
+    def __init__(self, app=None):
+        self.store = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_ENABLED', True)
+        app.config.setdefault('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+        app.config.setdefault('RESPONSE_CACHE_DIR', None)  # set to share the cache between workers
+        app.config.setdefault('RESPONSE_CACHE_TIMEOUT', 300)  # seconds, in case an invalidation is missed
+        app.config.setdefault('RESPONSE_CACHE_MAX_AGE', 60)  # what proxies and browsers are allowed
+        if app.config['RESPONSE_CACHE_DIR']:
+            self.store = FileStore(app.config['RESPONSE_CACHE_DIR'], app.config['RESPONSE_CACHE_MAX_BYTES'])
+        else:
+            self.store = MemoryStore(app.config['RESPONSE_CACHE_MAX_BYTES'])
+        app.extensions['response_cache'] = self
+
+    def key(self, tags):
+        generations = ','.join(f'{tag}={self.store.generation(tag)}' for tag in tags)
+        query = '&'.join(sorted(request.query_string.decode('latin-1').split('&')))
+        return f'{request.path}?{query}|{generations}'
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.store.bump(tag)
+
+    def respond(self, entry, status):
+        expires, mimetype, body, gzipped = entry
+        if gzipped and request.accept_encodings['gzip']:
+            response = Response(gzipped, mimetype=mimetype)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(body, mimetype=mimetype)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['RESPONSE_CACHE_MAX_AGE']
+        response.headers['X-Cache'] = status
+        return response
+
+
+def cached_page(*tags):
+    """Serve the view from the shared response cache.
+
+    Only for pages that don't depend on who is asking. `tags` name what the page
+    is built from and may use the view's arguments, e.g. 'influencer:{user_id}'.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            if cache is None or not current_app.config['RESPONSE_CACHE_ENABLED'] or \
+                    request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+
+            key = cache.key([tag.format(**kwargs) for tag in tags])
+            entry = cache.store.get(key)
+            if entry is not None:
+                cache.hits += 1
+                return cache.respond(entry, 'HIT')
+
+            cache.misses += 1
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or 'Set-Cookie' in response.headers:
+                return response
+            expires = time.time() + current_app.config['RESPONSE_CACHE_TIMEOUT']
+
+            if response.is_streamed:
+                # Keep streaming to this client and store the page once it has been sent in full.
+                # The tee must not refer to the response: a cycle would leave an unread stream
+                # to the garbage collector, which may close it in the middle of another request.
+                mimetype = response.mimetype
+
+                def tee(chunks):
+                    body = []
+                    for chunk in chunks:
+                        body.append(chunk)
+                        yield chunk
+                    body = b''.join(body)
+                    cache.store.set(key, (expires, mimetype, body, gzip.compress(body, mtime=0)))
+                original = response.response
+                response.response = tee(response.iter_encoded())
+                if hasattr(original, 'close'):
+                    response.call_on_close(original.close)  # the tee hides it from Response.close
+                response.headers.pop('ETag', None)  # stream_page's ETag is per user
+                response.cache_control.private = None
+                response.cache_control.no_cache = None
+                response.cache_control.public = True
+                response.cache_control.max_age = current_app.config['RESPONSE_CACHE_MAX_AGE']
+                response.headers['X-Cache'] = 'MISS'
+                return response
+
+            body = response.get_data()
+            entry = (expires, response.mimetype, body, gzip.compress(body, mtime=0))
+            cache.store.set(key, entry)
+            return cache.respond(entry, 'MISS')
+        return wrapped
+    return decorator
+
+
+def _influencer_tags(obj):
+    if isinstance(obj, InfluencerProfile):
+        return ('influencers', f'influencer:{obj.user_id}')
+    if isinstance(obj, User):
+        return ('influencers', f'influencer:{obj.id}')
+    return ()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, flush_context):
+    pending = session.info.setdefault(PENDING_KEY, set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        pending.update(_influencer_tags(obj))
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_bulk(orm_execute_state):
+    # UPDATE/DELETE statements (app.transaction's helpers) bypass the flush; the rows
+    # they touch are unknown, so every page built from the model is invalidated
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and \
+            orm_execute_state.bind_mapper is not None and \
+            orm_execute_state.bind_mapper.class_ in (User, InfluencerProfile):
+        orm_execute_state.session.info.setdefault(PENDING_KEY, set()).update(('influencers', 'influencer:*'))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate(session):
+    tags = session.info.pop(PENDING_KEY, None)
+    if tags and has_app_context():
+        cache = current_app.extensions.get('response_cache')
+        if cache is not None:
+            cache.invalidate(*tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop(PENDING_KEY, None)
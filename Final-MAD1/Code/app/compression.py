@@ -0,0 +1,70 @@
+import gzip
+import zlib
+
+from flask import current_app, request
+
+COMPRESSIBLE_MIMETYPES = ('text/html', 'text/css', 'text/plain', 'text/javascript',
+                          'application/javascript', 'application/json')
+
+
+def _gzip_stream(chunks, level, flush_size=16384):
+    # wbits=31 writes a gzip header. Output is flushed every `flush_size` input bytes so the
+    # browser can start parsing early without a sync flush after every tiny template chunk.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    pending = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= flush_size:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Compress:
+    """gzip-encodes text responses, and answers conditional GETs with 304 Not Modified."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        # Streamed responses are skipped: make_conditional would buffer the whole body to
+        # compute a Content-Length. Views that stream check their own ETag (app.rendering).
+        if request.method == 'GET' and response.status_code == 200 and \
+                not response.direct_passthrough and not response.is_streamed:
+            # Weak ETag: the same page may be sent gzipped or not, but it is semantically equal
+            if 'ETag' not in response.headers:
+                response.add_etag(weak=True)
+            response.make_conditional(request)
+
+        if not self._should_compress(response):
+            return response
+
+        level = current_app.config['COMPRESS_LEVEL']
+        if response.is_streamed:
+            response.response = _gzip_stream(response.response, level)
+            response.headers.pop('Content-Length', None)
+        else:
+            if response.content_length < current_app.config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(gzip.compress(response.get_data(), compresslevel=level, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def _should_compress(self, response):
+        return (response.status_code == 200
+                and not response.direct_passthrough
+                and 'Content-Encoding' not in response.headers
+                and response.mimetype in COMPRESSIBLE_MIMETYPES
+                and request.accept_encodings['gzip'])
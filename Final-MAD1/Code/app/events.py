@@ -0,0 +1,108 @@
+import json
+import queue
+import threading
+from collections import defaultdict
+
+try:
+    import redis
+except ImportError:  # only needed to fan events out across processes
+    redis = None
+
+
+class LocalBroker:
+    """Per-user fan-out of events to the SSE connections held by this process."""
+
+    def __init__(self, queue_size=100, max_subscribers=None):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscribers = defaultdict(set)  # user_id -> {queue.Queue}
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """A queue for a new connection, or None if this process already holds max_subscribers."""
+        subscription = queue.Queue(maxsize=self.queue_size)
+        with self.lock:
+            if self.max_subscribers is not None and self.count >= self.max_subscribers:
+                return None
+            self.subscribers[user_id].add(subscription)
+            self.count += 1
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self.lock:
+            subscriptions = self.subscribers.get(user_id)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            self.count -= 1
+            if not subscriptions:
+                del self.subscribers[user_id]
+
+    def publish(self, user_id, event):
+        self._deliver(user_id, event)
+
+    def _deliver(self, user_id, event):
+        with self.lock:
+            subscriptions = list(self.subscribers.get(user_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                pass  # a client that stopped reading loses events rather than blocking the publisher
+
+
+class RedisBroker(LocalBroker):
+    """Publishes through Redis so a user connected to any worker gets the event."""
+
+    CHANNEL_PREFIX = 'events:'
+
+    def __init__(self, url, queue_size=100, max_subscribers=None):
+        if redis is None:
+            raise RuntimeError('EVENTS_BROKER_URL points at Redis but the redis package is not installed')
+        super().__init__(queue_size, max_subscribers)
+        self.client = redis.Redis.from_url(url)
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.psubscribe(**{self.CHANNEL_PREFIX + '*': self._on_message})
+        self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def publish(self, user_id, event):
+        self.client.publish(f'{self.CHANNEL_PREFIX}{user_id}', json.dumps(event))
+
+    def _on_message(self, message):
+        user_id = int(message['channel'].decode()[len(self.CHANNEL_PREFIX):])
+        self._deliver(user_id, json.loads(message['data']))
+
+
+def broker_from_url(url, max_subscribers=None):
+    if url.startswith('memory://'):
+        return LocalBroker(max_subscribers=max_subscribers)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBroker(url, max_subscribers=max_subscribers)
+    raise ValueError(f'Unsupported EVENTS_BROKER_URL: {url}')
+
+
+class Events:
+    def __init__(self, app=None):
+        self.broker = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('EVENTS_BROKER_URL', 'memory://')
+        app.config.setdefault('EVENTS_HEARTBEAT', 15)  # seconds between keep-alive comments
+        # Each open stream holds a worker thread for as long as the page is open; keep
+        # this below the threads per process so ordinary requests are still served
+        app.config.setdefault('EVENTS_MAX_STREAMS', 20)
+        self.broker = broker_from_url(app.config['EVENTS_BROKER_URL'], app.config['EVENTS_MAX_STREAMS'])
+        app.extensions['events'] = self
+
+    def publish(self, user_ids, event):
+        for user_id in set(user_ids):
+            if user_id is not None:
+                self.broker.publish(user_id, event)
+
+    def ad_request_changed(self, ad_request_id, status, influencer_id, sponsor_id):
+        # Call after the commit, so a client reacting to the event reads the new state
+        self.publish((influencer_id, sponsor_id),
+                     {'type': 'ad_request', 'id': ad_request_id, 'status': status})
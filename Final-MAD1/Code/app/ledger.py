@@ -0,0 +1,125 @@
+import click
+from flask.cli import AppGroup
+from sqlalchemy import case, func, literal, or_, select, update
+
+from app import db
+from app.lifecycle import EXPIRED
+from app.models import AdRequest, Campaign
+
+ledger_cli = AppGroup('ledger', help='Check the committed amounts kept on each campaign.')
+
+# Ad requests in these states no longer hold any of the campaign's budget
+RELEASED_STATUSES = ('Rejected', EXPIRED)
+
+# Budgets and payments are floats; don't refuse a request over rounding noise
+TOLERANCE = 0.005
+
+
+class BudgetExceeded(Exception):
+    """Committing the amount would take the campaign over its budget."""
+
+
+def committed(status, amount):
+    """How much of its campaign's budget an ad request in `status` holds."""
+    return 0.0 if status in RELEASED_STATUSES else (amount or 0.0)
+
+
+def _adjust(campaign_where, delta):
+    # committed_amount += delta in one UPDATE; an increase only applies if it still fits the budget
+    if isinstance(delta, (int, float)):
+        delta = literal(delta)
+    stmt = update(Campaign).where(campaign_where).values(committed_amount=Campaign.committed_amount + delta)
+    stmt = stmt.where(or_(delta <= 0, Campaign.committed_amount + delta <= Campaign.budget + TOLERANCE))
+    return db.session.execute(stmt, execution_options={'synchronize_session': False}).rowcount == 1
+
+
+def adjust(campaign_id, delta):
+    """Move `delta` into (or, if negative, out of) a campaign's committed amount.
+
+    Raises BudgetExceeded instead of going over the budget. Runs in the caller's transaction.
+    """
+    if delta and not _adjust(Campaign.id == campaign_id, delta):
+        raise BudgetExceeded(f'Campaign {campaign_id} cannot commit another {delta:.2f}')
+
+
+def rewrite(ad_request_id, amount, status=None, campaign_id=None, owner_clause=None):
+    """Settle the ledger for an ad request about to get a new amount, before its UPDATE runs.
+
+    As in change_status, what the request holds now is read inside the UPDATEs. A
+    `status` or `campaign_id` of None is one the caller's UPDATE leaves as it is.
+    Returns False if the request was not found (or not owned); raises BudgetExceeded
+    if the new amount does not fit the budget.
+    """
+    ad_request = select(AdRequest).where(AdRequest.id == ad_request_id)
+    if owner_clause is not None:
+        ad_request = ad_request.where(owner_clause)
+    ad_request = ad_request.subquery()
+
+    held = ~ad_request.c.status.in_(RELEASED_STATUSES)
+    old = select(case((held, ad_request.c.payment_amount), else_=0.0)).scalar_subquery()
+    if status is None:
+        new = select(case((held, literal(amount or 0.0)), else_=0.0)).scalar_subquery()
+    else:
+        new = literal(committed(status, amount))
+    old_campaign = select(ad_request.c.campaign_id).scalar_subquery()
+
+    # Each campaign gets its net change, so a decrease always goes through, even on a
+    # campaign that is already over its budget; only increases are checked
+    if campaign_id is None:
+        stays = new
+    else:
+        moved = old_campaign != campaign_id
+        stays = case((moved, 0.0), else_=new)
+    if not _adjust(Campaign.id == old_campaign, stays - old):
+        if db.session.execute(select(ad_request.c.id)).first() is None:
+            return False
+        raise BudgetExceeded(f'Ad request {ad_request_id} cannot commit {amount:.2f}')
+    if campaign_id is not None and not _adjust(Campaign.id == campaign_id, case((moved, new), else_=0.0)):
+        raise BudgetExceeded(f'Ad request {ad_request_id} cannot commit {amount:.2f}')
+    return True
+
+
+def change_status(ad_request_id, status, owner_clause=None):
+    """Settle the ledger for an ad request about to move to `status`, before the status UPDATE runs.
+
+    The request's current status and amount are read inside the same UPDATE, so
+    nothing is loaded first. Returns False if the request was not found (or not
+    owned), or if re-committing it would exceed the budget; the caller's own
+    UPDATE tells the two apart.
+    """
+    ad_request = select(AdRequest).where(AdRequest.id == ad_request_id)
+    if owner_clause is not None:
+        ad_request = ad_request.where(owner_clause)
+    ad_request = ad_request.subquery()
+
+    held = ~ad_request.c.status.in_(RELEASED_STATUSES)
+    if status in RELEASED_STATUSES:
+        delta = case((held, -ad_request.c.payment_amount), else_=0.0)
+    else:
+        delta = case((held, 0.0), else_=ad_request.c.payment_amount)
+    delta = select(delta).scalar_subquery()
+    return _adjust(Campaign.id == select(ad_request.c.campaign_id).scalar_subquery(), delta)
+
+
+def totals():
+    """committed_amount as it should be, from the ad requests themselves."""
+    held = case((AdRequest.status.in_(RELEASED_STATUSES), 0.0), else_=AdRequest.payment_amount)
+    return select(AdRequest.campaign_id, func.sum(held)).group_by(AdRequest.campaign_id)
+
+
+@ledger_cli.command('check')
+@click.option('--fix', is_flag=True, help='Overwrite wrong totals with the recomputed ones.')
+def check_command(fix):
+    """Recompute every campaign's committed amount and report the ones that drifted."""
+    expected = dict(db.session.execute(totals()).all())
+    drifted = 0
+    for campaign_id, amount in db.session.execute(select(Campaign.id, Campaign.committed_amount)).all():
+        should_be = expected.get(campaign_id) or 0.0
+        if abs(should_be - amount) > TOLERANCE:
+            drifted += 1
+            click.echo(f'campaign {campaign_id}: committed {amount:.2f}, ad requests add up to {should_be:.2f}')
+            if fix:
+                db.session.execute(update(Campaign).where(Campaign.id == campaign_id)
+                                   .values(committed_amount=should_be))
+    db.session.commit()
+    click.echo(f'{drifted} campaign(s) {"fixed" if fix else "out of balance"}')
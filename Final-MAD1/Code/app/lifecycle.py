@@ -0,0 +1,98 @@
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, select, update
+
+from app import db
+from app.audit import record_bulk_change
+from app.models import AdRequest, Campaign, CampaignRecommendation
+
+lifecycle_cli = AppGroup('lifecycle', help='Close campaigns whose end date has passed.')
+
+# Status given to ad requests still waiting for an answer when their campaign closes
+EXPIRED = 'Expired'
+EXPIRING_STATUSES = ('Pending',)
+
+
+def close_campaigns(campaign_ids, now):
+    """Close the given campaigns and drop their recommendations. Runs in the caller's transaction."""
+    closed = db.session.scalars(
+        update(Campaign).where(Campaign.id.in_(campaign_ids), Campaign.closed_at.is_(None))
+        .values(closed_at=now).returning(Campaign.id),
+        execution_options={'synchronize_session': False}).all()
+    for campaign_id in closed:
+        record_bulk_change(db.session, Campaign, campaign_id, 'update', {'closed_at': now})
+    # Nobody is looking for influencers for a closed campaign any more
+    db.session.execute(delete(CampaignRecommendation).where(CampaignRecommendation.campaign_id.in_(campaign_ids)))
+    return len(closed)
+
+
+def expire_ad_requests(ad_request_ids):
+    """Expire the given ad requests (those still pending) and release their payments from the ledger.
+
+    Runs in the caller's transaction. Three statements whatever the number of requests.
+    """
+    still_pending = AdRequest.status.in_(EXPIRING_STATUSES)
+    expiring = select(AdRequest).where(AdRequest.id.in_(ad_request_ids), still_pending).subquery()
+    released = select(func.coalesce(func.sum(expiring.c.payment_amount), 0.0)) \
+        .where(expiring.c.campaign_id == Campaign.id).scalar_subquery()
+    # The ledger first: it reads the statuses the next UPDATE overwrites
+    db.session.execute(update(Campaign).where(Campaign.id.in_(select(expiring.c.campaign_id)))
+                       .values(committed_amount=Campaign.committed_amount - released),
+                       execution_options={'synchronize_session': False})
+    expired = db.session.scalars(
+        update(AdRequest).where(AdRequest.id.in_(ad_request_ids), still_pending)
+        .values(status=EXPIRED).returning(AdRequest.id),
+        execution_options={'synchronize_session': False}).all()
+    for ad_request_id in expired:
+        record_bulk_change(db.session, AdRequest, ad_request_id, 'update', {'status': EXPIRED})
+    return len(expired)
+
+
+def _batches(query, step, batch_size, pause):
+    # One short transaction per batch, so SQLite's write lock is only held briefly.
+    # Each step leaves its rows out of `query`, so the loop ends and a rerun finds nothing.
+    total = 0
+    while True:
+        ids = db.session.scalars(query.limit(batch_size)).all()
+        if not ids:
+            return total
+        try:
+            total += step(ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if pause:
+            time.sleep(pause)
+
+
+def process_lifecycle(batch_size=500, pause=0.0, now=None):
+    """Close campaigns that have ended and expire the pending ad requests of closed campaigns.
+
+    Idempotent: running it again (or after an interruption) only picks up what is left.
+    Returns (campaigns closed, ad requests expired).
+    """
+    now = now or datetime.utcnow()
+    # End dates are days (stored as midnight); a campaign runs until its end date is over
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    ending = select(Campaign.id).where(Campaign.closed_at.is_(None), Campaign.end_date < today).order_by(Campaign.id)
+    closed = _batches(ending, lambda ids: close_campaigns(ids, now), batch_size, pause)
+
+    # Also catches requests created on a campaign after it was closed
+    stale = select(AdRequest.id).join(Campaign, Campaign.id == AdRequest.campaign_id) \
+        .where(Campaign.closed_at.is_not(None), AdRequest.status.in_(EXPIRING_STATUSES)).order_by(AdRequest.id)
+    expired = _batches(stale, expire_ad_requests, batch_size, pause)
+    return closed, expired
+
+
+@lifecycle_cli.command('run')
+@click.option('--batch-size', default=500, show_default=True, help='Campaigns or ad requests per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to wait between batches.')
+def run_command(batch_size, pause):
+    """Close ended campaigns and expire their pending ad requests. Safe to run from cron."""
+    closed, expired = process_lifecycle(batch_size, pause)
+    click.echo(f'closed {closed} campaign(s), expired {expired} pending ad request(s)')
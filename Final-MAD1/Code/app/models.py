@@ -22,19 +22,34 @@ class User(db.Model, UserMixin):
 
 
 class Campaign(db.Model):
+    # Never reuse the id of a deleted row: archived campaigns keep theirs (app.archive)
+    __table_args__ = {'sqlite_autoincrement': True}
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=False)
     start_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     end_date = db.Column(db.DateTime, nullable=False)
     budget = db.Column(db.Float, nullable=False)
+    # Sum of payment_amount over ad requests still holding budget, kept up to date by app.ledger
+    committed_amount = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
     visibility = db.Column(db.String(10), nullable=False)  # 'public', 'private'
     goals = db.Column(db.Text, nullable=False)
     sponsor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     sponsor = db.relationship('User', backref='campaigns')
     flagged = db.Column(db.Boolean, default=False)
+    # Set by app.lifecycle once end_date has passed; closed campaigns leave the public listings
+    closed_at = db.Column(db.DateTime, nullable=True, index=True)
+
+    archived = False
+
+    @property
+    def remaining_budget(self):
+        return self.budget - self.committed_amount
 
 class AdRequest(db.Model):
+    __table_args__ = {'sqlite_autoincrement': True}  # see Campaign
+
     id = db.Column(db.Integer, primary_key=True)
     campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), nullable=False)
     influencer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -53,6 +68,70 @@ class InfluencerProfile(db.Model):
     niche = db.Column(db.String(100), nullable=True)
     reach = db.Column(db.String(25), nullable=True)
 
+# Append-only record of changes to flags, campaigns and ad request status/payment, written by app.audit
+class AuditLog(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    actor_id = db.Column(db.Integer, nullable=True)  # no foreign key: entries outlive the users they mention
+    action = db.Column(db.String(10), nullable=False)  # 'insert', 'update', 'delete'
+    entity = db.Column(db.String(30), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    field = db.Column(db.String(30), nullable=True)
+    old_value = db.Column(db.Text, nullable=True)
+    new_value = db.Column(db.Text, nullable=True)
+
+    __table_args__ = (db.Index('ix_audit_log_entity', 'entity', 'entity_id', 'created_at'),)
+
+# Top-K influencers per campaign, precomputed by app.recommendations
+class CampaignRecommendation(db.Model):
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id'), primary_key=True)
+    influencer_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+
+    campaign = db.relationship('Campaign', backref=db.backref('recommendations', cascade='all, delete-orphan'))
+    influencer = db.relationship('User')
+
+# Campaigns that ended long ago (or were deleted while they still had ad requests)
+# are moved here by app.archive so the live tables only hold the working set.
+class ArchivedCampaign(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.Text, nullable=False)
+    start_date = db.Column(db.DateTime, nullable=False)
+    end_date = db.Column(db.DateTime, nullable=False)
+    budget = db.Column(db.Float, nullable=False)
+    committed_amount = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    visibility = db.Column(db.String(10), nullable=False)
+    goals = db.Column(db.Text, nullable=False)
+    sponsor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    sponsor = db.relationship('User', backref='archived_campaigns')
+    flagged = db.Column(db.Boolean, default=False)
+    closed_at = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    archived = True
+
+class ArchivedAdRequest(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('archived_campaign.id'), nullable=False, index=True)
+    influencer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    messages = db.Column(db.Text, nullable=False)
+    requirements = db.Column(db.String(50), nullable=False)
+    payment_amount = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(15), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    campaign = db.relationship('ArchivedCampaign', backref='ad_requests')
+    influencer = db.relationship('User', backref='archived_ad_requests')
+
+    archived = True
+
+# Server-side session data (app.sessions); the cookie only carries the signed id
+class StoredSession(db.Model):
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -0,0 +1,351 @@
+"""Opt-in profiling of single requests.
+
+A request is profiled when an admin sends an ``X-Profile`` header, or at random
+for a PROFILE_SAMPLE_RATE fraction of all requests. Two profilers are available:
+
+- ``sample`` (the default): a background thread records the profiled thread's
+  stack every PROFILE_INTERVAL seconds. The request itself runs at full speed,
+  so this is the one to leave on in production.
+- ``cprofile``: cProfile traces every call. Exact counts, but the request runs
+  noticeably slower; ask for it explicitly with ``X-Profile: cprofile``.
+
+Only PROFILE_MAX_CONCURRENT requests per process are profiled at a time; the
+rest run unprofiled. The last PROFILE_MAX_RECORDS results are kept and can be
+downloaded from /admin/profiles as collapsed stacks (flamegraph.pl, speedscope),
+speedscope JSON, or a .prof file (pstats, snakeviz, speedscope).
+"""
+import cProfile
+import json
+import marshal
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+from flask import current_app, g, request
+from flask_login import current_user
+
+MODES = ('sample', 'cprofile')
+
+
+def _label(code, line):
+    # "function (file:line)", the frame format flamegraph tools expect; ';' separates frames
+    return f'{code.co_name} ({code.co_filename}:{line})'.replace(';', ':')
+
+
+def _stack(frame, max_depth):
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        # f_lineno is None while a frame runs code with no line number (Python 3.11+)
+        labels.append(_label(frame.f_code, frame.f_lineno or frame.f_code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Sampler:
+    """One thread per process that samples the stacks of the threads being profiled."""
+
+    def __init__(self, interval, max_depth=128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.targets = {}  # thread id -> (Counter of collapsed stacks, stop sampling at)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def add(self, thread_id, max_seconds):
+        stacks = Counter()
+        with self.lock:
+            self.targets[thread_id] = (stacks, time.monotonic() + max_seconds)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self.thread.start()
+            self.wake.set()
+        return stacks
+
+    def remove(self, thread_id):
+        with self.lock:
+            self.targets.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.interval)
+            with self.lock:  # held while counting, so remove() never hands back a Counter still in use
+                if not self.targets:
+                    self.wake.clear()  # sleep until the next profiled request
+                    continue
+                frames = sys._current_frames()
+                now = time.monotonic()
+                for thread_id, (stacks, until) in self.targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None and now < until:
+                        stacks[_stack(frame, self.max_depth)] += 1
+                del frames, frame  # don't keep the requests' frames, and their locals, alive while idle
+
+
+class MemoryStore:
+    """The most recent profiles of this process."""
+
+    def __init__(self, max_records):
+        self.records = deque(maxlen=max_records)  # (meta, payload), oldest first
+        self.lock = threading.Lock()
+
+    def add(self, meta, payload):
+        with self.lock:
+            self.records.append((meta, payload))
+
+    def list(self):
+        with self.lock:
+            return [meta for meta, _ in reversed(self.records)]
+
+    def get(self, profile_id):
+        with self.lock:
+            return next(((meta, payload) for meta, payload in self.records if meta['id'] == profile_id), None)
+
+
+class FileStore:
+    """Profiles as files in a directory, so a profile taken by one worker can be downloaded from any."""
+
+    def __init__(self, directory, max_records):
+        self.directory = directory
+        self.max_records = max_records
+        os.makedirs(directory, exist_ok=True)
+
+    def _files(self):
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.profile')]
+        return sorted(files, key=lambda entry: entry.name, reverse=True)  # ids start with the time
+
+    def add(self, meta, payload):
+        path = os.path.join(self.directory, meta['id'] + '.profile')
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8') + b'\n' + payload)
+        os.replace(temporary, path)
+        for entry in self._files()[self.max_records:]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass  # another worker got there first
+
+    def _read(self, path, with_payload):
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                return (meta, f.read()) if with_payload else meta
+        except (OSError, ValueError):
+            return None
+
+    def list(self):
+        return [meta for meta in (self._read(entry.path, False) for entry in self._files()) if meta]
+
+    def get(self, profile_id):
+        if not profile_id.isalnum():
+            return None
+        return self._read(os.path.join(self.directory, profile_id + '.profile'), True)
+
+
+class ProfileRun:
+    """One request being profiled."""
+
+    def __init__(self, mode, trigger, sampler, max_seconds):
+        # Time first, so ids sort in the order the profiles were taken
+        self.id = f'{time.time_ns():x}{secrets.token_hex(4)}'
+        self.mode = mode
+        self.trigger = trigger
+        self.status = None
+        self.sampler = sampler
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        if mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.thread_id = threading.get_ident()
+            self.stacks = sampler.add(self.thread_id, max_seconds)
+
+    def stop(self):
+        """Stop profiling; returns (meta, payload) ready to be stored."""
+        if self.mode == 'cprofile':
+            self.profile.disable()
+            self.profile.create_stats()
+            payload = marshal.dumps(self.profile.stats)  # the .prof format pstats reads
+            samples = None
+        else:
+            self.sampler.remove(self.thread_id)
+            payload = ''.join(f'{stack} {count}\n' for stack, count in self.stacks.items()).encode('utf-8')
+            samples = sum(self.stacks.values())
+        meta = {
+            'id': self.id,
+            'mode': self.mode,
+            'trigger': self.trigger,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': self.status,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'samples': samples,
+        }
+        return meta, payload
+
+
+def speedscope(meta, collapsed, interval):
+    """Convert collapsed stacks to speedscope's file format (https://www.speedscope.app)."""
+    frames, index = [], {}
+    samples, weights = [], []
+    for line in collapsed.decode('utf-8').splitlines():
+        stack, _, count = line.rpartition(' ')
+        sample = []
+        for label in stack.split(';'):
+            if label not in index:
+                name, _, location = label.rpartition(' (')
+                file, _, lineno = location.rstrip(')').rpartition(':')
+                index[label] = len(frames)
+                # Profiles saved before line numbers were always set may hold "None"
+                frames.append({'name': name, 'file': file, 'line': int(lineno) if lineno.isdigit() else 0})
+            sample.append(index[label])
+        samples.append(sample)
+        weights.append(int(count) * interval * 1000)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': f"{meta['method']} {meta['path']}",
+        'exporter': 'Influencer-Sponsor profiler',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': f"{meta['method']} {meta['path']} ({meta['started_at']})",
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights,
+        }],
+    }
+
+
+class Profiler:
+    def __init__(self, app=None):
+        self.store = None
+        self.sampler = None
+        self.slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)  # fraction of all requests profiled at random
+        app.config.setdefault('PROFILE_MODE', 'sample')  # profiler used unless the header asks for cprofile
+        app.config.setdefault('PROFILE_INTERVAL', 0.005)  # seconds between stack samples
+        app.config.setdefault('PROFILE_MAX_SECONDS', 30)  # stop sampling long-lived responses (event streams)
+        app.config.setdefault('PROFILE_MAX_CONCURRENT', 1)  # per process
+        app.config.setdefault('PROFILE_MAX_RECORDS', 50)
+        app.config.setdefault('PROFILE_DIR', None)  # set to share profiles between workers
+        # A profiled event stream would hold its slot for as long as the browser stays connected
+        app.config.setdefault('PROFILE_SKIP_ENDPOINTS', ('static', 'events.stream'))
+        if app.config['PROFILE_MODE'] not in MODES:
+            raise ValueError(f"PROFILE_MODE must be one of {', '.join(MODES)}")
+
+        if app.config['PROFILE_DIR']:
+            self.store = FileStore(app.config['PROFILE_DIR'], app.config['PROFILE_MAX_RECORDS'])
+        else:
+            self.store = MemoryStore(app.config['PROFILE_MAX_RECORDS'])
+        self.sampler = Sampler(app.config['PROFILE_INTERVAL'])
+        self.slots = threading.BoundedSemaphore(app.config['PROFILE_MAX_CONCURRENT'])
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        # Teardown rather than after_request: a streamed page is still rendering after the latter
+        app.teardown_request(self.teardown_request)
+        app.extensions['profiler'] = self
+
+    def _requested(self):
+        """(mode, trigger) if this request should be profiled, else None."""
+        if request.endpoint in current_app.config['PROFILE_SKIP_ENDPOINTS']:
+            return None
+        header = request.headers.get('X-Profile')
+        if header:
+            # Only admins may ask; for anyone else the header is ignored
+            if current_user.is_authenticated and current_user.role == 'admin':
+                return ('cprofile' if header.lower() == 'cprofile' else current_app.config['PROFILE_MODE']), 'header'
+            return None
+        rate = current_app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            return current_app.config['PROFILE_MODE'], 'sample'
+        return None
+
+    def before_request(self):
+        requested = self._requested()
+        if requested is None or not self.slots.acquire(blocking=False):
+            return
+        mode, trigger = requested
+        try:
+            g._profile = ProfileRun(mode, trigger, self.sampler, current_app.config['PROFILE_MAX_SECONDS'])
+        except Exception:
+            self.slots.release()
+            raise
+
+    def after_request(self, response):
+        run = g.get('_profile')
+        if run is not None:
+            run.status = response.status_code
+            response.headers['X-Profile-Id'] = run.id
+        return response
+
+    def teardown_request(self, exc):
+        run = g.pop('_profile', None)
+        if run is None:
+            return
+        try:
+            if run.status is None:
+                run.status = 500  # the view raised
+            self.store.add(*run.stop())
+        finally:
+            self.slots.release()
+
+    def records(self):
+        return self.store.list()
+
+    def merged(self, endpoint=None):
+        """All stored sampled profiles (of one endpoint) added together, as (meta, collapsed stacks).
+
+        A fast request yields only a few samples; at a low sample rate the picture
+        comes from adding many of them up.
+        """
+        stacks = Counter()
+        for meta in self.store.list():
+            if meta['mode'] != 'sample' or endpoint and meta['endpoint'] != endpoint:
+                continue
+            record = self.store.get(meta['id'])
+            for line in (record[1].decode('utf-8').splitlines() if record else ()):
+                stack, _, count = line.rpartition(' ')
+                stacks[stack] += int(count)
+        meta = {'mode': 'sample', 'method': 'ALL', 'path': endpoint or 'requests',
+                'started_at': datetime.utcnow().isoformat(timespec='seconds')}
+        return meta, ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()).encode('utf-8')
+
+    def download(self, profile_id, fmt, endpoint=None):
+        """(body, mimetype, filename) of a stored profile in `fmt`, or None if it isn't available in it.
+
+        The profile id 'merged' stands for the sum of all sampled profiles, see merged().
+        """
+        if profile_id == 'merged':
+            meta, payload = self.merged(endpoint)
+        else:
+            record = self.store.get(profile_id)
+            if record is None:
+                return None
+            meta, payload = record
+        if meta['mode'] == 'cprofile':
+            if fmt != 'prof':
+                return None  # cProfile keeps callers, not whole stacks
+            return payload, 'application/octet-stream', f'{profile_id}.prof'
+        if fmt == 'collapsed':
+            return payload, 'text/plain', f'{profile_id}.collapsed.txt'
+        if fmt == 'speedscope':
+            body = json.dumps(speedscope(meta, payload, current_app.config['PROFILE_INTERVAL']))
+            return body, 'application/json', f'{profile_id}.speedscope.json'
+        return None
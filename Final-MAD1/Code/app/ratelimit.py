@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+
+from flask import abort, current_app, make_response, request
+from flask_login import current_user
+
+try:
+    import redis
+except ImportError:  # only needed for a shared (multi-process) backend
+    redis = None
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(limit):
+    """'10/minute' -> (capacity, tokens refilled per second)."""
+    count, _, period = limit.partition('/')
+    count = int(count)
+    return count, count / PERIODS[period.strip().rstrip('s')]
+
+
+class MemoryBackend:
+    """Token buckets in a bounded LRU dict. Only shared by threads of one process."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> (tokens, last refill time)
+        self.lock = threading.Lock()
+
+    def consume(self, key, capacity, rate, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+
+class RedisBackend:
+    """Token buckets in Redis, shared by every worker. Each check is one atomic script call."""
+
+    SCRIPT = """
+    local capacity, rate, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * rate)
+    local allowed = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('RATELIMIT_STORAGE_URL points at Redis but the redis package is not installed')
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def consume(self, key, capacity, rate, cost=1):
+        allowed, tokens = self.script(keys=['ratelimit:' + key], args=[capacity, rate, time.time(), cost])
+        if allowed:
+            return True, 0
+        return False, (cost - float(tokens)) / rate
+
+
+def backend_from_url(url):
+    if url.startswith('memory://'):
+        return MemoryBackend()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    raise ValueError(f'Unsupported RATELIMIT_STORAGE_URL: {url}')
+
+
+# Key functions: each one names the thing a bucket is kept for
+def by_ip():
+    return 'ip:' + (request.remote_addr or 'unknown')
+
+
+def by_user():
+    if current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    return by_ip()
+
+
+def by_form_field(name):
+    def key():
+        value = request.form.get(name, '').strip().lower()
+        return f'{name}:{value}' if value else None
+    return key
+
+
+class RateLimiter:
+    def __init__(self, app=None):
+        self.backend = None
+        self.metrics = Counter()  # (endpoint, 'allowed'|'rejected') -> count, for this process
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE_URL', 'memory://')
+        app.config.setdefault('RATELIMIT_LOGIN', '10/minute')      # per IP and per account
+        app.config.setdefault('RATELIMIT_REGISTER', '5/hour')      # per IP
+        app.config.setdefault('RATELIMIT_MUTATIONS', '60/minute')  # per user on POST endpoints
+        self.backend = backend_from_url(app.config['RATELIMIT_STORAGE_URL'])
+        app.extensions['ratelimit'] = self
+
+    def check(self, config_key, *key_funcs):
+        """Take one token from the bucket of every key; abort with 429 if any is empty."""
+        if not current_app.config['RATELIMIT_ENABLED']:
+            return
+        capacity, rate = parse_limit(current_app.config[config_key])
+        for key_func in key_funcs:
+            key = key_func()
+            if key is None:
+                continue
+            allowed, retry_after = self.backend.consume(f'{config_key}:{key}', capacity, rate)
+            if not allowed:
+                self.metrics[(request.endpoint, 'rejected')] += 1
+                response = make_response('Too many requests. Please wait a moment and try again.', 429)
+                response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+                abort(response)
+        self.metrics[(request.endpoint, 'allowed')] += 1
+
+    def limit(self, config_key, *key_funcs, methods=('POST',)):
+        # Decorator for a single view; GETs (rendering the form) are not limited by default
+        def decorator(view):
+            @wraps(view)
+            def wrapped(*args, **kwargs):
+                if request.method in methods:
+                    self.check(config_key, *key_funcs)
+                return view(*args, **kwargs)
+            return wrapped
+        return decorator
+
+    def limit_blueprint(self, blueprint, config_key='RATELIMIT_MUTATIONS', methods=('POST',)):
+        @blueprint.before_request
+        def check_mutation():
+            if request.method in methods:
+                self.check(config_key, by_user)
+
+    def snapshot(self):
+        endpoints = {}
+        for (endpoint, outcome), count in self.metrics.items():
+            endpoints.setdefault(endpoint, {'allowed': 0, 'rejected': 0})[outcome] = count
+        return endpoints
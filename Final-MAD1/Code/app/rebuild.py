@@ -0,0 +1,280 @@
+"""Online, chunked rebuilds of large SQLite tables.
+
+SQLite cannot change a column's type in place, so Alembic's batch mode copies the
+whole table in one transaction and every writer waits until it is done. A
+TableRebuild does the same copy in steps that each hold the write lock briefly:
+
+1. create the new table next to the old one;
+2. add triggers that replay every insert, update and delete on the old table;
+3. copy the existing rows in rowid order, one short transaction per chunk;
+4. in one last transaction, compare row counts, drop the old table, rename the
+   new one and recreate the indexes and triggers.
+
+From a migration, run it outside Alembic's transaction:
+
+    with op.get_context().autocommit_block():
+        TableRebuild(op.get_bind().engine, 'ad_request', types={'status': sa.String(15)}).run()
+"""
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Index, MetaData, Table
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from app import db
+
+rebuild_cli = AppGroup('rebuild', help='Rebuild large tables without locking the database for the whole copy.')
+
+PREFIX = '_rebuild_'
+
+
+class TableRebuild:
+    def __init__(self, engine, table_name, types=None, chunk_size=1000, pause=0.0):
+        if engine.dialect.name != 'sqlite':
+            raise ValueError('TableRebuild is only needed (and only implemented) for SQLite')
+        self.engine = engine
+        self.table_name = table_name
+        self.types = types or {}  # column name -> new SQLAlchemy type
+        self.chunk_size = chunk_size
+        self.pause = pause  # seconds between chunks, so the app's writes get the lock in between
+        self.new_name = PREFIX + table_name
+
+    def _connect(self):
+        # Autocommit at the driver level, so BEGIN IMMEDIATE / COMMIT below are the only transactions
+        return self.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+    def _quote(self, name):
+        return self.engine.dialect.identifier_preparer.quote(name)
+
+    def _tables(self, connection):
+        metadata = MetaData()
+        old = Table(self.table_name, metadata, autoload_with=connection)  # also loads referenced tables
+        new = old.to_metadata(metadata, name=self.new_name)
+        new.indexes.clear()  # index names are global; the real ones are created after the swap
+        if self._autoincrement(connection):
+            new.dialect_kwargs['sqlite_autoincrement'] = True  # reflection doesn't see it
+        for name, type_ in self.types.items():
+            new.c[name].type = type_
+        return old, new
+
+    def _autoincrement(self, connection):
+        sql = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                         (self.table_name,)).scalar()
+        return 'AUTOINCREMENT' in (sql or '').upper()
+
+    def _columns(self, old, new):
+        return ', '.join(self._quote(column.name) for column in new.columns if column.name in old.columns)
+
+    def changes(self):
+        with self._connect() as connection:
+            old, new = self._tables(connection)
+        dialect = self.engine.dialect
+        return [(column.name, old.c[column.name].type.compile(dialect), column.type.compile(dialect))
+                for column in new.columns
+                if column.type.compile(dialect) != old.c[column.name].type.compile(dialect)]
+
+    def _cleanup(self, connection):
+        # Leftovers of an interrupted run
+        for suffix in ('insert', 'update', 'delete'):
+            connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {self._quote(self.new_name + "_" + suffix)}')
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS {self._quote(self.new_name)}')
+
+    def _replication_triggers(self, old, new):
+        source, target = self._quote(self.table_name), self._quote(self.new_name)
+        names = [column.name for column in new.columns if column.name in old.columns]
+        columns = ', '.join(self._quote(name) for name in names)
+        values = ', '.join(f'NEW.{self._quote(name)}' for name in names)
+        key = ' AND '.join(f'{self._quote(column.name)} = OLD.{self._quote(column.name)}'
+                           for column in old.primary_key.columns) or 'rowid = OLD.rowid'
+        upsert = f'INSERT OR REPLACE INTO {target} ({columns}) VALUES ({values});'
+        return [
+            f'CREATE TRIGGER {self._quote(self.new_name + "_insert")} AFTER INSERT ON {source} BEGIN {upsert} END',
+            f'CREATE TRIGGER {self._quote(self.new_name + "_update")} AFTER UPDATE ON {source} '
+            f'BEGIN DELETE FROM {target} WHERE {key}; {upsert} END',
+            f'CREATE TRIGGER {self._quote(self.new_name + "_delete")} AFTER DELETE ON {source} '
+            f'BEGIN DELETE FROM {target} WHERE {key}; END',
+        ]
+
+    def _copy_chunk(self, connection, old, new, after, last):
+        source, target = self._quote(self.table_name), self._quote(self.new_name)
+        columns = self._columns(old, new)
+        scanned, upto = connection.exec_driver_sql(
+            f'SELECT count(*), max(rowid) FROM '
+            f'(SELECT rowid FROM {source} WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?)',
+            (after, last, self.chunk_size)).one()
+        if scanned:
+            # OR IGNORE: rows the triggers already copied are newer than what is read here
+            connection.exec_driver_sql(
+                f'INSERT OR IGNORE INTO {target} ({columns}) SELECT {columns} FROM {source} '
+                f'WHERE rowid > ? AND rowid <= ?', (after, upto))
+        return scanned, upto
+
+    def _sequence(self, connection, name):
+        if not connection.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_sequence'").first():
+            return None
+        return connection.exec_driver_sql('SELECT seq FROM sqlite_sequence WHERE name = ?', (name,)).scalar()
+
+    def _count(self, connection, name):
+        return connection.exec_driver_sql(f'SELECT count(*) FROM {self._quote(name)}').scalar()
+
+    def estimate(self):
+        """Row count, plus the time of one sample chunk and its indexes scaled up to the whole table.
+
+        The sample is copied into the real new table and rolled back, so nothing is left behind.
+        """
+        with self._connect() as connection:
+            old, new = self._tables(connection)
+            rows = self._count(connection, self.table_name)
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                self._cleanup(connection)
+                connection.execute(CreateTable(new))
+                started = time.monotonic()
+                sampled, _ = self._copy_chunk(connection, old, new, -2 ** 63, 2 ** 63 - 1)
+                copy_seconds = time.monotonic() - started
+                started = time.monotonic()
+                for index in old.indexes:
+                    columns = [new.c[column.name] for column in index.columns]
+                    connection.execute(CreateIndex(Index(PREFIX + index.name, *columns, unique=index.unique)))
+                index_seconds = time.monotonic() - started
+            finally:
+                connection.exec_driver_sql('ROLLBACK')
+        scale = rows / sampled if sampled else 0
+        chunks = -(-rows // self.chunk_size)
+        return {
+            'rows': rows,
+            'chunks': chunks,
+            'copy_seconds': copy_seconds * scale + self.pause * chunks,
+            'lock_seconds': copy_seconds,  # longest single hold of the write lock while copying
+            'swap_seconds': index_seconds * scale,
+        }
+
+    def run(self, progress=None):
+        """Rebuild the table. `progress(copied, total, elapsed)` is called after every chunk."""
+        with self._connect() as connection:
+            old, new = self._tables(connection)
+            other_triggers = connection.exec_driver_sql(
+                "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ? AND name NOT LIKE ?",
+                (self.table_name, PREFIX + '%')).scalars().all()
+
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                self._cleanup(connection)
+                connection.execute(CreateTable(new))
+                for statement in self._replication_triggers(old, new):
+                    connection.exec_driver_sql(statement)
+                total = self._count(connection, self.table_name)
+                # Rows inserted after this point reach the new table through the triggers
+                last = connection.exec_driver_sql(f'SELECT max(rowid) FROM {self._quote(self.table_name)}').scalar()
+                connection.exec_driver_sql('COMMIT')
+            except Exception:
+                connection.exec_driver_sql('ROLLBACK')
+                raise
+
+            try:
+                started = time.monotonic()
+                copied, after = 0, -2 ** 63
+                while True:
+                    connection.exec_driver_sql('BEGIN IMMEDIATE')
+                    try:
+                        scanned, after = self._copy_chunk(connection, old, new, after, last)
+                        connection.exec_driver_sql('COMMIT')
+                    except Exception:
+                        connection.exec_driver_sql('ROLLBACK')
+                        raise
+                    if not scanned:
+                        break
+                    copied += scanned
+                    if progress:
+                        progress(copied, total, time.monotonic() - started)
+                    if self.pause:
+                        time.sleep(self.pause)
+                self._swap(connection, old, other_triggers)
+            except Exception:
+                self._cleanup(connection)
+                raise
+
+    def _swap(self, connection, old, other_triggers):
+        foreign_keys = connection.exec_driver_sql('PRAGMA foreign_keys').scalar()
+        # Both pragmas are no-ops inside a transaction, so set them before BEGIN.
+        # legacy_alter_table keeps SQLite from rewriting references to the renamed table.
+        connection.exec_driver_sql('PRAGMA foreign_keys = OFF')
+        connection.exec_driver_sql('PRAGMA legacy_alter_table = ON')
+        try:
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                for suffix in ('insert', 'update', 'delete'):
+                    connection.exec_driver_sql(f'DROP TRIGGER {self._quote(self.new_name + "_" + suffix)}')
+                old_rows, new_rows = self._count(connection, self.table_name), self._count(connection, self.new_name)
+                if old_rows != new_rows:
+                    raise RuntimeError(f'{self.table_name}: copied {new_rows} rows but the table has {old_rows}')
+                # AUTOINCREMENT's high-water mark may be above every row still in the table
+                sequence = self._sequence(connection, self.table_name)
+                connection.exec_driver_sql(f'DROP TABLE {self._quote(self.table_name)}')
+                connection.exec_driver_sql(
+                    f'ALTER TABLE {self._quote(self.new_name)} RENAME TO {self._quote(self.table_name)}')
+                if sequence is not None:
+                    sequence = max(sequence, self._sequence(connection, self.table_name) or 0)
+                    connection.exec_driver_sql('DELETE FROM sqlite_sequence WHERE name = ?', (self.table_name,))
+                    connection.exec_driver_sql('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)',
+                                               (self.table_name, sequence))
+                for index in old.indexes:
+                    connection.execute(CreateIndex(index))
+                for statement in other_triggers:
+                    connection.exec_driver_sql(statement)
+                connection.exec_driver_sql('COMMIT')
+            except Exception:
+                connection.exec_driver_sql('ROLLBACK')
+                raise
+        finally:
+            connection.exec_driver_sql('PRAGMA legacy_alter_table = OFF')
+            connection.exec_driver_sql(f'PRAGMA foreign_keys = {"ON" if foreign_keys else "OFF"}')
+
+
+def _model_types(table_name):
+    # The target of a rebuild from the command line is the table as app.models defines it
+    table = db.metadata.tables.get(table_name)
+    if table is None:
+        raise click.ClickException(f'No model defines a table named {table_name!r}')
+    return {column.name: column.type for column in table.columns}
+
+
+@rebuild_cli.command('table')
+@click.argument('table_name')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows copied per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to wait between chunks.')
+@click.option('--dry-run', is_flag=True, help='Only estimate how long the rebuild would take.')
+def table_command(table_name, chunk_size, pause, dry_run):
+    """Rebuild TABLE_NAME so its column types match the models, e.g. ahead of a type-changing migration."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('Only SQLite needs table rebuilds; other databases alter columns in place')
+    with db.engine.connect() as connection:
+        existing = Table(table_name, MetaData(), autoload_with=connection)
+    types = {name: type_ for name, type_ in _model_types(table_name).items() if name in existing.columns}
+    rebuild = TableRebuild(db.engine, table_name, types=types, chunk_size=chunk_size, pause=pause)
+
+    for column, before, after in rebuild.changes():
+        click.echo(f'{table_name}.{column}: {before} -> {after}')
+
+    if dry_run:
+        estimate = rebuild.estimate()
+        click.echo(f"{estimate['rows']} rows in {estimate['chunks']} chunk(s) of {chunk_size}")
+        click.echo(f"estimated copy time {estimate['copy_seconds']:.1f}s, each chunk holding the write lock "
+                   f"for about {estimate['lock_seconds'] * 1000:.0f}ms")
+        click.echo(f"estimated final swap (locked) {estimate['swap_seconds']:.1f}s")
+        return
+
+    last_reported = [0.0]
+
+    def report(copied, total, elapsed):
+        if elapsed - last_reported[0] >= 1 or copied == total:
+            last_reported[0] = elapsed
+            remaining = elapsed / copied * (total - copied) if copied else 0
+            click.echo(f'{copied}/{total} rows ({copied * 100 // max(total, 1)}%), '
+                       f'{elapsed:.1f}s elapsed, about {remaining:.1f}s left')
+
+    started = time.monotonic()
+    rebuild.run(progress=report)
+    click.echo(f'rebuilt {table_name} in {time.monotonic() - started:.1f}s')
@@ -0,0 +1,263 @@
+import math
+import re
+import threading
+import time
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import case, delete, func, select
+
+from app import db
+from app.models import AdRequest, Campaign, CampaignRecommendation, InfluencerProfile, User
+from app.transaction import transaction
+
+recommendations_cli = AppGroup('recommendations', help='Precompute influencer recommendations for campaigns.')
+
+# Weights of the three signals in the final score
+TEXT_WEIGHT = 0.6
+REACH_WEIGHT = 0.25
+ACCEPTANCE_WEIGHT = 0.15
+
+STOP_WORDS = {'the', 'and', 'for', 'with', 'our', 'your', 'you', 'are', 'this', 'that', 'from',
+              'will', 'who', 'all', 'new', 'into', 'more', 'about', 'their', 'them', 'they'}
+REACH_SUFFIXES = {'k': 1e3, 'm': 1e6, 'b': 1e9}
+
+
+def tokenize(text):
+    return [word for word in re.findall(r'[a-z0-9]+', (text or '').lower())
+            if len(word) > 2 and word not in STOP_WORDS]
+
+
+def parse_reach(reach):
+    # '12,500', '10k', '1.2M followers' -> number of followers
+    match = re.search(r'([\d.,]+)\s*([kmb])?', (reach or '').lower())
+    if not match:
+        return 0.0
+    try:
+        value = float(match.group(1).replace(',', ''))
+    except ValueError:
+        return 0.0
+    return value * REACH_SUFFIXES.get(match.group(2), 1)
+
+
+def _normalize(vector):
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    return {term: weight / norm for term, weight in vector.items()} if norm else {}
+
+
+class ProfileIndex:
+    """TF-IDF term vectors of every influencer profile, kept as an inverted index.
+
+    Scoring a campaign only walks the postings of the campaign's own terms, so
+    all influencers are scored in one pass without comparing vectors pairwise.
+    """
+
+    def __init__(self):
+        self.influencer_ids = []
+        self.postings = defaultdict(list)  # term -> [(influencer_id, weight)]
+        self.vectors = {}     # influencer_id -> {term: weight}, the same weights by influencer
+        self.idf = {}
+        self.top_reach = 1.0  # log-scaled follower count that maps to a reach of 1
+        self.reach = {}       # influencer_id -> 0..1, log-scaled
+        self.acceptance = {}  # influencer_id -> smoothed acceptance rate
+
+    @classmethod
+    def build(cls):
+        index = cls()
+        rows = db.session.execute(
+            select(User.id, InfluencerProfile.category, InfluencerProfile.niche, InfluencerProfile.reach)
+            .outerjoin(InfluencerProfile, InfluencerProfile.user_id == User.id)
+            .where(User.role == 'influencer')
+        ).all()
+        index.influencer_ids = [row.id for row in rows]
+
+        documents = {row.id: tokenize(f'{row.category or ""} {row.niche or ""}') for row in rows}
+        document_frequency = defaultdict(int)
+        for terms in documents.values():
+            for term in set(terms):
+                document_frequency[term] += 1
+        total = len(documents)
+        index.idf = {term: math.log((total + 1) / (df + 1)) + 1 for term, df in document_frequency.items()}
+
+        for influencer_id, terms in documents.items():
+            counts = defaultdict(int)
+            for term in terms:
+                counts[term] += 1
+            vector = _normalize({term: count * index.idf[term] for term, count in counts.items()})
+            index.vectors[influencer_id] = vector
+            for term, weight in vector.items():
+                index.postings[term].append((influencer_id, weight))
+
+        followers = {row.id: parse_reach(row.reach) for row in rows}
+        index.top_reach = math.log10(1 + max(followers.values(), default=0)) or 1
+        index.reach = {influencer_id: math.log10(1 + count) / index.top_reach
+                       for influencer_id, count in followers.items()}
+
+        # One aggregate over all ad requests: accepted / (accepted + rejected), smoothed towards 0.5
+        decided = db.session.execute(
+            select(AdRequest.influencer_id,
+                   func.sum(case((AdRequest.status == 'Accepted', 1), else_=0)),
+                   func.sum(case((AdRequest.status.in_(['Accepted', 'Rejected']), 1), else_=0)))
+            .group_by(AdRequest.influencer_id)
+        ).all()
+        index.acceptance = {influencer_id: (accepted + 1) / (total_decided + 2)
+                            for influencer_id, accepted, total_decided in decided}
+        return index
+
+    def update_influencer(self, influencer_id, category, niche, reach):
+        """Replace one influencer's terms and reach, keeping everyone else's as built.
+
+        The IDF of existing terms and the reach scale are not recomputed, so scores
+        drift slightly from a full build until the index is next rebuilt. Lists are
+        replaced rather than changed in place, so concurrent scoring stays safe.
+        """
+        for term in self.vectors.get(influencer_id, ()):
+            self.postings[term] = [posting for posting in self.postings[term] if posting[0] != influencer_id]
+        counts = defaultdict(int)
+        for term in tokenize(f'{category or ""} {niche or ""}'):
+            counts[term] += 1
+        for term in counts:
+            # A term no other influencer used when the index was built
+            self.idf.setdefault(term, math.log((len(self.influencer_ids) + 1) / 2) + 1)
+        vector = _normalize({term: count * self.idf[term] for term, count in counts.items()})
+        for term, weight in vector.items():
+            self.postings[term] = self.postings[term] + [(influencer_id, weight)]
+        self.vectors[influencer_id] = vector
+        if influencer_id not in self.reach:
+            self.influencer_ids = self.influencer_ids + [influencer_id]
+        self.reach[influencer_id] = min(1.0, math.log10(1 + parse_reach(reach)) / self.top_reach)
+
+    def campaign_vector(self, campaign):
+        counts = defaultdict(int)
+        for term in tokenize(f'{campaign.name} {campaign.description} {campaign.goals}'):
+            if term in self.idf:  # terms no influencer uses cannot contribute
+                counts[term] += 1
+        return _normalize({term: count * self.idf[term] for term, count in counts.items()})
+
+    def score_all(self, campaign):
+        similarity = defaultdict(float)
+        for term, campaign_weight in self.campaign_vector(campaign).items():
+            for influencer_id, weight in self.postings[term]:
+                similarity[influencer_id] += campaign_weight * weight
+        return {influencer_id: self._combine(influencer_id, similarity.get(influencer_id, 0.0))
+                for influencer_id in self.influencer_ids}
+
+    def score_one(self, campaign, influencer_id):
+        vector = self.vectors.get(influencer_id, {})
+        similarity = sum(campaign_weight * vector.get(term, 0.0)
+                         for term, campaign_weight in self.campaign_vector(campaign).items())
+        return self._combine(influencer_id, similarity)
+
+    def _combine(self, influencer_id, similarity):
+        return (TEXT_WEIGHT * similarity
+                + REACH_WEIGHT * self.reach.get(influencer_id, 0.0)
+                + ACCEPTANCE_WEIGHT * self.acceptance.get(influencer_id, 0.5))
+
+
+def _top_k():
+    return current_app.config.get('RECOMMENDATIONS_TOP_K', 10)
+
+
+_index_lock = threading.Lock()
+
+
+def current_index():
+    """This process's ProfileIndex, rebuilt once it is RECOMMENDATIONS_INDEX_MAX_AGE seconds old.
+
+    A build reads every profile and aggregates all ad requests, far too much for
+    each save; profile saves patch the cached index instead (update_influencer),
+    and the periodic rebuild picks up IDF and acceptance-rate changes.
+    """
+    with _index_lock:
+        index, built = current_app.extensions.get('recommendations_index', (None, 0.0))
+        if index is None or time.monotonic() - built > current_app.config.get('RECOMMENDATIONS_INDEX_MAX_AGE', 300):
+            index = ProfileIndex.build()
+            current_app.extensions['recommendations_index'] = (index, time.monotonic())
+        return index
+
+
+def _store(campaign_id, ranked):
+    db.session.execute(delete(CampaignRecommendation).where(CampaignRecommendation.campaign_id == campaign_id))
+    if ranked:
+        db.session.execute(CampaignRecommendation.__table__.insert(), [
+            {'campaign_id': campaign_id, 'influencer_id': influencer_id, 'score': score}
+            for influencer_id, score in ranked
+        ])
+
+
+def _rank(scores, k):
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+def refresh_campaign(campaign):
+    """Recompute the top-K list of one campaign and store it in a transaction of its own.
+
+    Call it once the campaign is committed: ranking only reads, so SQLite's write
+    lock is held just while the stored list is replaced.
+    """
+    ranked = _rank(current_index().score_all(campaign), _top_k())
+    with transaction():
+        _store(campaign.id, ranked)
+
+
+def refresh_influencer(influencer_id):
+    """Re-score one influencer against every open campaign and merge the result into the stored lists.
+
+    Call it once the profile change is committed. Scoring only reads; the lists that
+    actually change are written together in one short transaction of its own.
+    """
+    profile = db.session.get(InfluencerProfile, influencer_id)
+    index = current_index()
+    if profile is not None:
+        index.update_influencer(influencer_id, profile.category, profile.niche, profile.reach)
+    k = _top_k()
+    stored = defaultdict(dict)
+    for row in CampaignRecommendation.query.all():
+        stored[row.campaign_id][row.influencer_id] = row.score
+
+    changed = {}
+    for campaign in Campaign.query.filter(Campaign.closed_at.is_(None)).all():
+        current = stored.get(campaign.id, {})
+        score = index.score_one(campaign, influencer_id)
+        previous = current.get(influencer_id)
+        truncated = len(current) >= k
+        if len(current) < min(k, len(index.influencer_ids)) or \
+                (truncated and previous is not None and score < previous):
+            # The list is incomplete, or the influencer fell and someone unlisted may now outrank them
+            changed[campaign.id] = _rank(index.score_all(campaign), k)
+            continue
+        merged = dict(current)
+        merged[influencer_id] = score
+        ranked = _rank(merged, k)
+        if dict(ranked) != current:
+            changed[campaign.id] = ranked
+
+    if changed:
+        with transaction():
+            for campaign_id, ranked in changed.items():
+                _store(campaign_id, ranked)
+
+
+def refresh_all():
+    """Rebuild every open campaign's list from a fresh index. The caller commits."""
+    index = ProfileIndex.build()
+    # Closed campaigns (app.lifecycle) keep no recommendations
+    campaigns = Campaign.query.filter(Campaign.closed_at.is_(None)).all()
+    for campaign in campaigns:
+        _store(campaign.id, _rank(index.score_all(campaign), _top_k()))
+    return len(campaigns)
+
+
+def recommended_influencers(campaign_id):
+    return CampaignRecommendation.query.filter_by(campaign_id=campaign_id) \
+        .order_by(CampaignRecommendation.score.desc()).all()
+
+
+@recommendations_cli.command('refresh')
+def refresh_command():
+    """Recompute every campaign's list, e.g. nightly so acceptance rates stay current."""
+    count = refresh_all()
+    db.session.commit()
+    click.echo(f'refreshed recommendations for {count} campaign(s)')
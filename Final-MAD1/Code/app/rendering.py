@@ -0,0 +1,49 @@
+import hashlib
+
+from flask import Response, get_flashed_messages, request, stream_template
+from flask_login import current_user
+from sqlalchemy import inspect
+
+
+def rows_etag(template_name, *collections):
+    """Weak ETag over every column value of the rows a page is rendered from.
+
+    Hashing the rows is much cheaper than rendering them, so an unchanged page
+    can be answered with 304 Not Modified before any HTML is built.
+    """
+    digest = hashlib.sha1(template_name.encode('utf-8'))
+    digest.update(repr(current_user.get_id()).encode('utf-8'))
+    for rows in collections:
+        if not isinstance(rows, (list, tuple)):
+            rows = [rows]
+        for row in rows:
+            if row is None:
+                digest.update(b'-')
+                continue
+            mapper = inspect(row).mapper
+            values = tuple(getattr(row, attr.key) for attr in mapper.column_attrs)
+            digest.update(repr((mapper.class_.__name__, values)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def stream_page(template_name, etag_rows=(), **context):
+    """Stream a large template to the client, or answer 304 if it has not changed.
+
+    `etag_rows` must contain every row the template reads from, including rows it
+    reaches through relationships, otherwise a stale page could be reported as
+    unchanged.
+    """
+    # The template shows flashed messages while streaming, after the session is saved, so take
+    # them out of the session now; Flask keeps them on the request for the template's own call.
+    # They would be lost on a 304, so always render in that case
+    etag = None if get_flashed_messages() else rows_etag(template_name, *etag_rows)
+
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(stream_template(template_name, **context), mimetype='text/html')
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
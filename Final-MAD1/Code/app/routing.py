@@ -0,0 +1,87 @@
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+
+# Cookie set after a write; until it expires the user's reads stay on the primary. Kept out of
+# the session, so a write does not also rewrite the stored session. It is not signed: a
+# client can only use it to send its own reads to the primary
+STICKY_COOKIE = 'db_primary_until'
+
+
+def _sticky_until():
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0))
+    except ValueError:
+        return 0
+
+
+def read_only(view):
+    """Serve a GET view from the read replica.
+
+    A user who wrote something in the last REPLICA_STICKY_SECONDS keeps reading
+    from the primary, so the page they are redirected to shows their change even
+    if the replica has not caught up yet.
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if _sticky_until() < time.time():
+            g.db_read_only = True
+        return view(*args, **kwargs)
+    return wrapped
+
+
+class RoutingSession(Session):
+    """Sends reads of `read_only` views to the replica engine, everything else to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            is_write = self._flushing or (clause is not None and getattr(clause, 'is_dml', False))
+            if is_write:
+                g.db_wrote = True
+            elif g.get('db_read_only'):
+                replica = current_app.extensions.get('replica_engine')
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _read_only_sqlite(url):
+    # A second connection to the same file that SQLite itself refuses to write through.
+    # Not immutable=1: the primary keeps changing the file, and immutable readers would
+    # skip locking and could see torn pages.
+    engine = create_engine(f'sqlite:///file:{url.database}?mode=ro&uri=true')
+
+    @event.listens_for(engine, 'connect')
+    def _query_only(dbapi_connection, connection_record):
+        dbapi_connection.execute('PRAGMA query_only = ON')
+
+    return engine
+
+
+def init_replica(app, db):
+    app.config.setdefault('SQLALCHEMY_REPLICA_ENABLED', True)
+    app.config.setdefault('SQLALCHEMY_REPLICA_URI', None)  # defaults to a read-only view of a SQLite primary
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+
+    if not app.config['SQLALCHEMY_REPLICA_ENABLED']:
+        return
+    if app.config['SQLALCHEMY_REPLICA_URI']:
+        replica = create_engine(app.config['SQLALCHEMY_REPLICA_URI'])
+    else:
+        with app.app_context():
+            url = db.engine.url
+        if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+            return
+        replica = _read_only_sqlite(url)
+    app.extensions['replica_engine'] = replica
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.get('db_wrote'):
+            seconds = app.config['REPLICA_STICKY_SECONDS']
+            response.set_cookie(STICKY_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True,
+                                samesite='Lax', secure=request.is_secure)
+        return response
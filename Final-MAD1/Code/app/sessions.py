@@ -0,0 +1,289 @@
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, session as current_session
+from flask.cli import AppGroup
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from flask_login import user_logged_in
+from itsdangerous import BadSignature, Signer, URLSafeTimedSerializer
+from sqlalchemy import bindparam, delete, select, update
+
+try:
+    import redis
+except ImportError:  # only needed to share sessions through Redis
+    redis = None
+
+from app import db
+from app.models import StoredSession
+
+sessions_cli = AppGroup('sessions', help='Maintain the server-side session store.')
+
+# Only sessions holding one of these are stored on the server; anonymous ones (a CSRF
+# token, flashed messages) travel in a signed cookie, so a visitor costs no write
+SERVER_KEYS = ('_user_id',)
+
+
+class ServerSession(SecureCookieSession):
+    """Session data kept on the server once a user logs in; the cookie only holds its signed id."""
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires_at = expires_at  # of the stored copy; None until it is first saved
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Move the data to a fresh id, so an id obtained before login is useless after it."""
+        if self.sid is not None and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class MemoryStore:
+    """Sessions held by this process only, least recently used evicted first."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # sid -> (data, expires_at)
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry is None:
+                return None
+            if entry[1] <= datetime.utcnow():
+                del self.entries[sid]
+                return None
+            self.entries.move_to_end(sid)
+            return entry
+
+    def save(self, sid, data, expires_at, new):
+        with self.lock:
+            self.entries[sid] = (data, expires_at)
+            self.entries.move_to_end(sid)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def touch(self, sid, expires_at):
+        with self.lock:
+            if sid in self.entries:
+                self.entries[sid] = (self.entries[sid][0], expires_at)
+
+    def delete(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+    def sweep(self):
+        now = datetime.utcnow()
+        with self.lock:
+            expired = [sid for sid, (_, expires_at) in self.entries.items() if expires_at <= now]
+            for sid in expired:
+                del self.entries[sid]
+        return len(expired)
+
+
+class DatabaseStore:
+    """Sessions in the stored_session table, so every worker sees them. One statement per operation."""
+
+    table = StoredSession.__table__
+    # Built once: constructing the statement costs more than running it
+    load_stmt = select(table.c.data, table.c.expires_at) \
+        .where(table.c.id == bindparam('sid'), table.c.expires_at > bindparam('now'))
+
+    def load(self, sid):
+        with db.engine.connect() as connection:
+            row = connection.execute(self.load_stmt, {'sid': sid, 'now': datetime.utcnow()}).first()
+        return tuple(row) if row else None
+
+    def save(self, sid, data, expires_at, new):
+        if new:
+            stmt = self.table.insert().values(id=sid, data=data, expires_at=expires_at)
+        else:
+            stmt = update(self.table).where(self.table.c.id == sid).values(data=data, expires_at=expires_at)
+        with db.engine.begin() as connection:
+            connection.execute(stmt)
+
+    def touch(self, sid, expires_at):
+        with db.engine.begin() as connection:
+            connection.execute(update(self.table).where(self.table.c.id == sid).values(expires_at=expires_at))
+
+    def delete(self, sid):
+        with db.engine.begin() as connection:
+            connection.execute(delete(self.table).where(self.table.c.id == sid))
+
+    def sweep(self):
+        with db.engine.begin() as connection:
+            return connection.execute(delete(self.table).where(self.table.c.expires_at <= datetime.utcnow())).rowcount
+
+
+class RedisStore:
+    """Sessions in Redis, shared by every worker. Redis expires them itself, so there is nothing to sweep."""
+
+    PREFIX = 'session:'
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('SESSION_STORE_URL points at Redis but the redis package is not installed')
+        self.client = redis.Redis.from_url(url)
+
+    def load(self, sid):
+        data, ttl = self.client.pipeline().get(self.PREFIX + sid).ttl(self.PREFIX + sid).execute()
+        if data is None:
+            return None
+        return data.decode('utf-8'), datetime.utcnow() + timedelta(seconds=max(ttl, 0))
+
+    def save(self, sid, data, expires_at, new):
+        self.client.set(self.PREFIX + sid, data, ex=self._seconds_until(expires_at))
+
+    def touch(self, sid, expires_at):
+        self.client.expire(self.PREFIX + sid, self._seconds_until(expires_at))
+
+    def delete(self, sid):
+        self.client.delete(self.PREFIX + sid)
+
+    def sweep(self):
+        return 0
+
+    @staticmethod
+    def _seconds_until(expires_at):
+        return max(1, int((expires_at - datetime.utcnow()).total_seconds()))
+
+
+def store_from_url(url):
+    if url.startswith('memory://'):
+        return MemoryStore()
+    if url.startswith('db://'):
+        return DatabaseStore()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    raise ValueError(f'Unsupported SESSION_STORE_URL: {url}')
+
+
+class ServerSessionInterface(SessionInterface):
+    session_class = ServerSession
+    serializer = TaggedJSONSerializer()  # same format as Flask's cookies, so flashes and Markup survive
+    salt = 'session-id'
+    anonymous_salt = 'anonymous-session'
+
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def _keys(app):
+        # Signers use the last key to sign and accept any of them, so old cookies
+        # stay valid while SECRET_KEY_FALLBACKS still lists the previous key
+        return [*(app.config['SECRET_KEY_FALLBACKS'] or []), app.secret_key]
+
+    def get_signer(self, app):
+        return Signer(self._keys(app), salt=self.salt)
+
+    def get_anonymous_serializer(self, app):
+        return URLSafeTimedSerializer(self._keys(app), salt=self.anonymous_salt, serializer=self.serializer)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self.get_signer(app).unsign(cookie).decode('ascii')
+            except BadSignature:
+                sid = None
+            stored = self.store.load(sid) if sid else None
+            if stored is not None:
+                data, expires_at = stored
+                return self.session_class(self.serializer.loads(data), sid, expires_at)
+            if sid is None:
+                try:
+                    max_age = app.permanent_session_lifetime.total_seconds()
+                    return self.session_class(self.get_anonymous_serializer(app).loads(cookie, max_age=max_age))
+                except BadSignature:
+                    pass
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            # Nothing worth keeping: no row and no cookie
+            if session.modified:
+                if session.sid:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+                response.vary.add('Cookie')
+            return
+
+        now = datetime.utcnow()
+        lifetime = app.permanent_session_lifetime
+        if not any(key in session for key in SERVER_KEYS):
+            # Anonymous, or just logged out: the data itself goes in the cookie
+            if session.sid:
+                self.store.delete(session.sid)
+            if session.modified or session.sid:
+                value = self.get_anonymous_serializer(app).dumps(dict(session))
+                set_cookie = True
+            else:
+                set_cookie = False
+        elif session.modified or session.sid is None:
+            new = session.sid is None
+            if new:
+                session.sid = secrets.token_urlsafe(24)
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), now + lifetime, new)
+            value = self.get_signer(app).sign(session.sid).decode('ascii')
+            set_cookie = True
+        elif session.expires_at - now < lifetime / 2:
+            # Extend an active session once per half lifetime rather than writing on every request
+            self.store.touch(session.sid, now + lifetime)
+            set_cookie = session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']
+            value = self.get_signer(app).sign(session.sid).decode('ascii')
+        else:
+            set_cookie = False
+
+        if set_cookie:
+            response.set_cookie(name, value, expires=self.get_expiration_time(app, session), httponly=httponly,
+                                domain=domain, path=path, secure=secure, samesite=samesite)
+            response.vary.add('Cookie')
+            if response.cache_control.public:
+                # A shared cache must never hand this visitor's cookie to someone else
+                response.cache_control.public = None
+                response.cache_control.private = True
+
+
+def _regenerate_on_login(app, user):
+    if isinstance(current_session._get_current_object(), ServerSession):
+        current_session.regenerate()
+
+
+class ServerSessions:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # One process (python run.py) needs nothing shared; several workers need db:// or redis://
+        app.config.setdefault('SESSION_STORE_URL', 'memory://')
+        app.session_interface = ServerSessionInterface(store_from_url(app.config['SESSION_STORE_URL']))
+        user_logged_in.connect(_regenerate_on_login, app)
+        app.extensions['sessions'] = self
+
+
+@sessions_cli.command('sweep')
+def sweep_command():
+    """Delete expired sessions, e.g. hourly from cron."""
+    count = current_app.session_interface.store.sweep()
+    click.echo(f'deleted {count} expired session(s)')
@@ -0,0 +1,81 @@
+import logging
+from contextlib import contextmanager
+
+from flask import abort, current_app, g, has_request_context, request
+from sqlalchemy import delete, event, update
+from sqlalchemy.engine import Engine
+
+from app import db
+from app.audit import record_bulk_change
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def transaction():
+    """Unit of work for a view: commit if the block succeeds, roll back and re-raise if it fails."""
+    try:
+        yield db.session
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _execute_owned(stmt, model, ident, owner_clause, returning):
+    stmt = stmt.where(model.id == ident)
+    if owner_clause is not None:
+        stmt = stmt.where(owner_clause)
+    if returning:
+        row = db.session.execute(stmt.returning(*returning),
+                                 execution_options={'synchronize_session': False}).first()
+        return row is not None, row
+    return db.session.execute(stmt, execution_options={'synchronize_session': False}).rowcount == 1, None
+
+
+def update_owned(model, ident, owner_clause=None, returning=(), **values):
+    """UPDATE ... WHERE id = ident AND <owner_clause> in a single statement.
+
+    Returns True if the row was changed. False means it either does not exist
+    or is not owned by the caller; use `get_or_404` to tell the two apart only
+    on that (rare) path. With `returning` columns, the updated row (or None)
+    is returned instead, still without a second statement.
+    """
+    changed, row = _execute_owned(update(model).values(**values), model, ident, owner_clause, returning)
+    if changed:
+        record_bulk_change(db.session, model, ident, 'update', values)
+    return row if returning else changed
+
+
+def delete_owned(model, ident, owner_clause=None, returning=()):
+    """DELETE ... WHERE id = ident AND <owner_clause>; same contract as `update_owned`."""
+    deleted, row = _execute_owned(delete(model), model, ident, owner_clause, returning)
+    if deleted:
+        record_bulk_change(db.session, model, ident, 'delete')
+    return row if returning else deleted
+
+
+def get_or_404(model, ident):
+    row = db.session.get(model, ident)
+    if row is None:
+        abort(404)
+    return row
+
+
+# Statement counting, to measure how many round-trips a request makes
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+
+
+def init_statement_counter(app):
+    app.config.setdefault('SQL_COUNT_STATEMENTS', False)
+
+    @app.after_request
+    def report_statements(response):
+        if current_app.config['SQL_COUNT_STATEMENTS']:
+            count = g.get('sql_statements', 0)
+            response.headers['X-SQL-Statements'] = str(count)
+            logger.info('%s: %d SQL statement(s)', request.endpoint, count)
+        return response
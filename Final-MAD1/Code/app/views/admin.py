@@ -1,45 +1,101 @@
-from flask import Blueprint, render_template, redirect, url_for, flash
+from datetime import datetime, timedelta
+from flask import Blueprint, Response, current_app, render_template, redirect, url_for, flash, abort, jsonify, request
 from flask_login import login_required, current_user
-from app.models import User, Campaign, AdRequest
-from app import db
+from sqlalchemy.orm import joinedload
+from app.models import User, Campaign, AdRequest, AuditLog
+from app import limiter, profiler
+from app.rendering import stream_page
+from app.routing import read_only
+from app.transaction import transaction, update_owned
 
 admin_bp = Blueprint('admin', __name__)
 
 @admin_bp.route('/dashboard')
 @login_required
+@read_only
 def dashboard():
     # Fetch statistics for admin
     total_users = User.query.count()
     total_campaigns = Campaign.query.count()
     total_ad_requests = AdRequest.query.count()
     
-    # Fetch all users, campaigns, and ad requests
+    # Fetch all users, campaigns, and ad requests. The page is streamed after the
+    # session is closed, so everything the template reaches must be loaded here
     users = User.query.filter(User.id != current_user.id).all()  # Exclude current admin
-    campaigns = Campaign.query.all()
-    ad_requests = AdRequest.query.all()
+    campaigns = Campaign.query.options(joinedload(Campaign.sponsor)).all()
+    ad_requests = AdRequest.query.options(joinedload(AdRequest.campaign), joinedload(AdRequest.influencer)).all()
     
     # Show flagged users or campaigns (filter example, assuming flag field exists)
     flagged_users = User.query.filter_by(flagged=True).all()
-    flagged_campaigns = Campaign.query.filter_by(flagged=True).all()
+    flagged_campaigns = Campaign.query.options(joinedload(Campaign.sponsor)).filter_by(flagged=True).all()
 
-    return render_template('admin/dashboard.html', total_users=total_users, total_campaigns=total_campaigns, total_ad_requests=total_ad_requests,
-                           users=users, campaigns=campaigns, ad_requests=ad_requests,
-                           flagged_users=flagged_users, flagged_campaigns=flagged_campaigns)
+    # Every row the page shows (sponsor and influencer names included) is in these lists
+    etag_rows = (users, current_user._get_current_object(), campaigns, ad_requests)
+
+    return stream_page('admin/dashboard.html', etag_rows, total_users=total_users, total_campaigns=total_campaigns, total_ad_requests=total_ad_requests,
+                       users=users, campaigns=campaigns, ad_requests=ad_requests,
+                       flagged_users=flagged_users, flagged_campaigns=flagged_campaigns)
 
 @admin_bp.route('/flag_user/<int:user_id>', methods=['POST'])
 @login_required
 def flag_user(user_id):
-    user = User.query.get_or_404(user_id)
-    user.flagged = True  # Assuming User model has 'flagged' field
-    db.session.commit()
+    with transaction():
+        if not update_owned(User, user_id, flagged=True):
+            abort(404)
     flash('User has been flagged.', 'success')
     return redirect(url_for('admin.dashboard'))
 
 @admin_bp.route('/flag_campaign/<int:campaign_id>', methods=['POST'])
 @login_required
 def flag_campaign(campaign_id):
-    campaign = Campaign.query.get_or_404(campaign_id)
-    campaign.flagged = True  # Assuming Campaign model has 'flagged' field
-    db.session.commit()
+    with transaction():
+        if not update_owned(Campaign, campaign_id, flagged=True):
+            abort(404)
     flash('Campaign has been flagged.', 'success')
     return redirect(url_for('admin.dashboard'))
+
+@admin_bp.route('/metrics/ratelimit')
+@login_required
+def ratelimit_metrics():
+    if current_user.role != 'admin':
+        abort(403)
+    # Allowed/rejected counts per endpoint, for this worker process
+    return jsonify(limiter.snapshot())
+
+@admin_bp.route('/audit')
+@login_required
+def audit_log():
+    if current_user.role != 'admin':
+        abort(403)
+
+    # Time range filter (dates as YYYY-MM-DD), defaulting to the last 7 days
+    until = request.args.get('until', type=lambda value: datetime.strptime(value, '%Y-%m-%d')) or datetime.utcnow()
+    since = request.args.get('since', type=lambda value: datetime.strptime(value, '%Y-%m-%d')) or until - timedelta(days=7)
+    query = AuditLog.query.filter(AuditLog.created_at >= since, AuditLog.created_at < until + timedelta(days=1))
+    if request.args.get('entity'):
+        query = query.filter(AuditLog.entity == request.args['entity'])
+    entries = query.order_by(AuditLog.created_at.desc()).limit(500).all()
+
+    actors = {user.id: user.username for user in User.query.filter(User.id.in_({e.actor_id for e in entries})).all()}
+    return render_template('admin/audit.html', entries=entries, actors=actors, since=since, until=until,
+                           entity=request.args.get('entity', ''))
+
+@admin_bp.route('/profiles')
+@login_required
+def profiles():
+    if current_user.role != 'admin':
+        abort(403)
+    # Requests profiled with the X-Profile header or by PROFILE_SAMPLE_RATE, newest first
+    return render_template('admin/profiles.html', records=profiler.records(),
+                           sample_rate=current_app.config['PROFILE_SAMPLE_RATE'])
+
+@admin_bp.route('/profiles/<profile_id>.<fmt>')
+@login_required
+def download_profile(profile_id, fmt):
+    if current_user.role != 'admin':
+        abort(403)
+    download = profiler.download(profile_id, fmt, request.args.get('endpoint'))
+    if download is None:
+        abort(404)
+    body, mimetype, filename = download
+    return Response(body, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename={filename}'})
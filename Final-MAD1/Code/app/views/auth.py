@@ -1,13 +1,16 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from app import db  
+from app import db, limiter
+from app.transaction import transaction
+from app.ratelimit import by_ip, by_form_field
 from app.models import User  
 from app.forms import RegistrationForm, LoginForm
 
 auth_bp = Blueprint('auth', __name__)
 
 @auth_bp.route('/register', methods=['GET', 'POST'])
+@limiter.limit('RATELIMIT_REGISTER', by_ip)
 def register():
     if current_user.is_authenticated:
         if current_user.role == 'Admin':
@@ -22,13 +25,15 @@ def register():
         hashed_password = generate_password_hash(form.password.data)
         user = User(username=form.username.data, email=form.email.data,
                     password=hashed_password, role=form.role.data)
-        db.session.add(user)
-        db.session.commit()
+        with transaction():
+            db.session.add(user)
         flash('Your account has been created! You are now able to log in', 'success')
         return redirect(url_for('auth.login'))
     return render_template('auth/register.html', form=form)
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
+# Checked before the password hash is computed, per client and per targeted account
+@limiter.limit('RATELIMIT_LOGIN', by_ip, by_form_field('email'))
 def login():
     if current_user.is_authenticated:
         if current_user.role == 'admin':
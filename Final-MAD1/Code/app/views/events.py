@@ -0,0 +1,39 @@
+import json
+import queue
+
+from flask import Blueprint, Response, current_app
+from flask_login import login_required, current_user
+from app import db, events
+
+events_bp = Blueprint('events', __name__)
+
+@events_bp.route('/stream')
+@login_required
+def stream():
+    user_id = current_user.id
+    heartbeat = current_app.config['EVENTS_HEARTBEAT']
+    subscription = events.broker.subscribe(user_id)
+    if subscription is None:
+        # Every stream slot of this process is taken; the page works without live updates
+        return Response(status=503, headers={'Retry-After': '60'})
+
+    # The connection stays open for as long as the page does; don't hold a database connection with it
+    db.session.remove()
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = subscription.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            events.broker.unsubscribe(user_id, subscription)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # stop nginx from buffering the stream
+    return response
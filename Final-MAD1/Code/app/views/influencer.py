@@ -1,15 +1,27 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_required, current_user
-from app import db
+from sqlalchemy import select
+from app import db, limiter, events
+from app.transaction import transaction, update_owned, get_or_404
+from app.recommendations import refresh_influencer
+from app.ledger import BudgetExceeded, change_status, rewrite
+from app.lifecycle import EXPIRED
+from app.routing import read_only
 from app.models import Campaign, AdRequest
 from app.forms import AdRequestForm
 from app.forms import InfluencerProfileForm
 from app.models import InfluencerProfile
 
 influencer_bp = Blueprint('influencer', __name__)
+limiter.limit_blueprint(influencer_bp)
+
+# Returned by the status UPDATE so the sponsor can be notified without another query
+ad_request_sponsor_id = select(Campaign.sponsor_id).where(Campaign.id == AdRequest.campaign_id) \
+    .scalar_subquery().label('sponsor_id')
 
 @influencer_bp.route('/dashboard')
 @login_required
+@read_only
 def dashboard():
     # Fetch ad requests for the influencer
     ad_requests = AdRequest.query.filter_by(influencer_id=current_user.id).all()
@@ -35,30 +47,54 @@ def view_ad_request(ad_request_id):
 @influencer_bp.route('/accept_ad_request/<int:ad_request_id>', methods=['POST'])
 @login_required
 def accept_ad_request(ad_request_id):
-    ad_request = AdRequest.query.get_or_404(ad_request_id)
-    
-    # Ensure the current user is the owner of the ad request
-    if ad_request.influencer_id != current_user.id:
-        flash('You are not authorized to accept this ad request.', 'danger')
+    influencer_id = current_user.id  # read before the commit expires the user
+
+    # Ownership is part of the UPDATEs themselves, so no SELECT is needed first.
+    # An expired request went with its campaign and cannot be accepted any more.
+    owned = (AdRequest.influencer_id == influencer_id) & (AdRequest.status != EXPIRED)
+    try:
+        with transaction():
+            # The ledger goes first: it reads the status the second UPDATE overwrites
+            settled = change_status(ad_request_id, 'Accepted', owned)
+            updated = update_owned(AdRequest, ad_request_id, owned,
+                                   returning=(ad_request_sponsor_id,), status='Accepted')
+            if updated and not settled:
+                raise BudgetExceeded(f'Ad request {ad_request_id} no longer fits its campaign budget')
+    except BudgetExceeded:
+        flash('This ad request no longer fits in the campaign budget.', 'danger')
+        return redirect(url_for('influencer.dashboard'))
+
+    if not updated:
+        ad_request = get_or_404(AdRequest, ad_request_id)
+        if ad_request.influencer_id == influencer_id and ad_request.status == EXPIRED:
+            flash('This ad request expired when its campaign ended.', 'danger')
+        else:
+            flash('You are not authorized to accept this ad request.', 'danger')
         return redirect(url_for('influencer.dashboard'))
 
-    ad_request.status = 'Accepted'
-    db.session.commit()
+    events.ad_request_changed(ad_request_id, 'Accepted', influencer_id, updated.sponsor_id)
     flash('Ad request accepted.', 'success')
     return redirect(url_for('influencer.dashboard'))
 
 @influencer_bp.route('/reject_ad_request/<int:ad_request_id>', methods=['POST'])
 @login_required
 def reject_ad_request(ad_request_id):
-    ad_request = AdRequest.query.get_or_404(ad_request_id)
-    
-    # Ensure the current user is the owner of the ad request
-    if ad_request.influencer_id != current_user.id:
+    influencer_id = current_user.id  # read before the commit expires the user
+
+    # Ownership is part of the UPDATEs themselves, so no SELECT is needed first
+    owned = AdRequest.influencer_id == influencer_id
+    with transaction():
+        # Releases the payment from the campaign's committed amount; it cannot fail on budget
+        change_status(ad_request_id, 'Rejected', owned)
+        updated = update_owned(AdRequest, ad_request_id, owned,
+                               returning=(ad_request_sponsor_id,), status='Rejected')
+
+    if not updated:
+        get_or_404(AdRequest, ad_request_id)
         flash('You are not authorized to reject this ad request.', 'danger')
         return redirect(url_for('influencer.dashboard'))
 
-    ad_request.status = 'Rejected'
-    db.session.commit()
+    events.ad_request_changed(ad_request_id, 'Rejected', influencer_id, updated.sponsor_id)
     flash('Ad request rejected.', 'success')
     return redirect(url_for('influencer.dashboard'))
 
@@ -71,6 +107,10 @@ def negotiate_ad_request(ad_request_id):
         flash('You do not have permission to negotiate this ad request.', 'danger')
         return redirect(url_for('influencer.dashboard'))
 
+    if ad_request.status == EXPIRED:
+        flash('This ad request expired when its campaign ended.', 'danger')
+        return redirect(url_for('influencer.dashboard'))
+
     form = AdRequestForm()
 
     # Populate choices for campaign and influencer
@@ -78,17 +118,27 @@ def negotiate_ad_request(ad_request_id):
     form.influencer_id.choices = [(ad_request.influencer.id, ad_request.influencer.username)]
 
     if form.validate_on_submit():
+        # Expired meanwhile? The ledger and the row are only touched if it still is not
+        owned = (AdRequest.influencer_id == current_user.id) & (AdRequest.status != EXPIRED)
         try:
-            ad_request.messages = form.messages.data
-            ad_request.payment_amount = form.payment_amount.data
-            ad_request.status = 'Negotiating'  # Set the status to Negotiating
-
-            db.session.commit()
+            with transaction():
+                # The amount held now is read inside the ledger UPDATEs, not taken from `ad_request`
+                negotiating = rewrite(ad_request_id, form.payment_amount.data, 'Negotiating', owner_clause=owned)
+                if negotiating:
+                    update_owned(AdRequest, ad_request_id, owned, messages=form.messages.data,
+                                 payment_amount=form.payment_amount.data,
+                                 status='Negotiating')  # Set the status to Negotiating
+            if not negotiating:
+                flash('This ad request expired when its campaign ended.', 'danger')
+                return redirect(url_for('influencer.dashboard'))
+            events.ad_request_changed(ad_request.id, ad_request.status, ad_request.influencer_id,
+                                      ad_request.campaign.sponsor_id)
             flash('Your negotiation request has been sent!', 'success')
             return redirect(url_for('influencer.dashboard'))
+        except BudgetExceeded:
+            flash('That amount is more than the campaign has left in its budget.', 'danger')
         except Exception as e:
             flash(f"An error occurred: {str(e)}", 'danger')
-            db.session.rollback()
     elif request.method == 'GET':
         form.messages.data = ad_request.messages
         form.requirements.data = ad_request.requirements
@@ -107,9 +157,8 @@ def negotiate_ad_request(ad_request_id):
 def profile():
     # Ensure the user has a profile, if not, create one
     if not current_user.influencer_profile:
-        profile = InfluencerProfile(user_id=current_user.id)
-        db.session.add(profile)
-        db.session.commit()
+        with transaction():
+            db.session.add(InfluencerProfile(user_id=current_user.id))
 
     form = InfluencerProfileForm()
 
@@ -120,10 +169,13 @@ def profile():
         form.reach.data = current_user.influencer_profile.reach
 
     if form.validate_on_submit():
-        current_user.influencer_profile.category = form.category.data
-        current_user.influencer_profile.niche = form.niche.data
-        current_user.influencer_profile.reach = form.reach.data
-        db.session.commit()
+        influencer_id = current_user.id  # read before the commit expires the user
+        with transaction():
+            current_user.influencer_profile.category = form.category.data
+            current_user.influencer_profile.niche = form.niche.data
+            current_user.influencer_profile.reach = form.reach.data
+        # After the commit: re-scoring must not hold the write lock
+        refresh_influencer(influencer_id)
         flash('Profile updated successfully!', 'success')
         return redirect(url_for('influencer.dashboard'))
 
@@ -131,13 +183,14 @@ def profile():
 
 @influencer_bp.route('/public-ad')
 @login_required
+@read_only
 def public_ad_requests():
     if current_user.role != 'influencer':
         flash('You are not authorized to access this page.', 'danger')
         return redirect(url_for('main.index'))
 
-    # Query all public campaigns
-    public_campaigns = Campaign.query.filter_by(visibility='public').all()
+    # Query all public campaigns that are still running
+    public_campaigns = Campaign.query.filter_by(visibility='public').filter(Campaign.closed_at.is_(None)).all()
 
     # Get ad requests related to public campaigns
     public_ad_requests = AdRequest.query.filter(AdRequest.campaign_id.in_(
@@ -1,14 +1,27 @@
+from datetime import datetime
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_required, current_user
-from app import db
+from sqlalchemy import or_, select
+from sqlalchemy.orm import joinedload
+from app import db, limiter, events
+from app.rendering import stream_page
+from app.archive import archive_campaigns
+from app.ledger import BudgetExceeded, TOLERANCE, adjust, committed, rewrite
+from app.lifecycle import EXPIRED
+from app.recommendations import recommended_influencers, refresh_campaign
+from app.routing import read_only
+from app.cache import cached_page
+from app.transaction import transaction, update_owned, delete_owned, get_or_404
 from app.forms import CampaignForm, AdRequestForm
-from app.models import Campaign, AdRequest, User, InfluencerProfile
+from app.models import Campaign, AdRequest, User, InfluencerProfile, ArchivedCampaign
 
 
 sponsor_bp = Blueprint('sponsor', __name__)
+limiter.limit_blueprint(sponsor_bp)
 
 @sponsor_bp.route('/dashboard')
 @login_required
+@read_only
 def dashboard():
     # Fetch campaigns owned by the sponsor
     campaigns = Campaign.query.filter_by(sponsor_id=current_user.id).all()
@@ -17,10 +30,18 @@ def dashboard():
     ad_requests = AdRequest.query.filter(AdRequest.campaign_id.in_(
         [campaign.id for campaign in campaigns])).all()
 
+    # Archived campaigns are left out unless asked for
+    show_archived = request.args.get('archived') == '1'
+    archived_campaigns = []
+    if show_archived:
+        archived_campaigns = ArchivedCampaign.query.filter_by(sponsor_id=current_user.id) \
+            .order_by(ArchivedCampaign.archived_at.desc()).all()
+
     # Check if the sponsor is flagged
     flagged = current_user.flagged  # Assuming 'flagged' is a column in the User model
 
-    return render_template('sponsor/dashboard.html', campaigns=campaigns, ad_requests=ad_requests, flagged=flagged)
+    return render_template('sponsor/dashboard.html', campaigns=campaigns, ad_requests=ad_requests, flagged=flagged,
+                           show_archived=show_archived, archived_campaigns=archived_campaigns)
 
 
 
@@ -39,8 +60,10 @@ def create_campaign():
             goals=form.goals.data,
             sponsor_id=current_user.id
         )
-        db.session.add(campaign)
-        db.session.commit()
+        with transaction():
+            db.session.add(campaign)
+        # After the commit: ranking influencers must not hold the write lock
+        refresh_campaign(campaign)
         flash('Your campaign has been created!', 'success')
         return redirect(url_for('sponsor.dashboard'))
     return render_template('sponsor/create_campaign.html', form=form)
@@ -51,14 +74,27 @@ def edit_campaign(campaign_id):
     campaign = Campaign.query.get_or_404(campaign_id)
     form = CampaignForm()
     if form.validate_on_submit():
-        campaign.name = form.name.data
-        campaign.description = form.description.data
-        campaign.start_date = form.start_date.data
-        campaign.end_date = form.end_date.data
-        campaign.budget = form.budget.data
-        campaign.visibility = form.visibility.data
-        campaign.goals = form.goals.data
-        db.session.commit()
+        values = dict(name=form.name.data, description=form.description.data, start_date=form.start_date.data,
+                      end_date=form.end_date.data, budget=form.budget.data, visibility=form.visibility.data,
+                      goals=form.goals.data)
+        if campaign.closed_at is not None and form.end_date.data >= datetime.utcnow().date():
+            values['closed_at'] = None  # the end date was moved: running again
+        with transaction():
+            # Only a lower budget is checked, in the UPDATE itself, against the amount committed at that moment
+            updated = update_owned(Campaign, campaign_id,
+                                   (Campaign.sponsor_id == current_user.id)
+                                   & or_(Campaign.budget <= form.budget.data,
+                                         Campaign.committed_amount <= form.budget.data + TOLERANCE), **values)
+        if not updated and campaign.sponsor_id != current_user.id:
+            flash('You are not authorized to edit this campaign.', 'danger')
+            return redirect(url_for('sponsor.dashboard'))
+        if not updated:
+            # The commit expired `campaign`, so this is the amount that was just compared
+            flash(f'The budget cannot be lower than the ${campaign.committed_amount:.2f} '
+                  'already committed to ad requests.', 'danger')
+            return render_template('sponsor/edit_campaign.html', form=form)
+        if campaign.closed_at is None:
+            refresh_campaign(campaign)
         flash('Your campaign has been updated!', 'success')
         return redirect(url_for('sponsor.dashboard'))
     elif request.method == 'GET':
@@ -72,22 +108,28 @@ def edit_campaign(campaign_id):
     return render_template('sponsor/edit_campaign.html', form=form)
 
 @sponsor_bp.route('/sponsor/delete_campaign/<int:campaign_id>', methods=['POST'])
+@login_required
 def delete_campaign(campaign_id):
     campaign = Campaign.query.get_or_404(campaign_id)
 
-    # Check if the campaign has any associated ad requests
-    ad_requests = AdRequest.query.filter_by(campaign_id=campaign_id).all()
-
-    if ad_requests:
-        flash('Ad-requests already exist, so Campaign cannot be deleted.', 'danger')
+    if campaign.sponsor_id != current_user.id:
+        flash('You are not authorized to delete this campaign.', 'danger')
         return redirect(url_for('sponsor.dashboard'))
 
+    # Check if the campaign has any associated ad requests
+    has_ad_requests = db.session.query(AdRequest.query.filter_by(campaign_id=campaign_id).exists()).scalar()
+
     try:
-        db.session.delete(campaign)
-        db.session.commit()
-        flash('Campaign deleted successfully!', 'success')
-    except:
-        db.session.rollback()
+        with transaction():
+            if has_ad_requests:
+                # Keep the ad request history: move the campaign and its requests to the archive
+                archive_campaigns([campaign.id])
+                message = 'Campaign archived together with its ad requests.'
+            else:
+                db.session.delete(campaign)
+                message = 'Campaign deleted successfully!'
+        flash(message, 'success')
+    except Exception:
         flash('Error occurred while deleting the campaign.', 'danger')
 
     return redirect(url_for('sponsor.dashboard'))
@@ -96,8 +138,15 @@ def delete_campaign(campaign_id):
 @login_required
 def create_ad_request():
     form = AdRequestForm()
-    form.campaign_id.choices = [(c.id, c.name) for c in Campaign.query.filter_by(sponsor_id=current_user.id).all()]
+    # Only running campaigns; app.lifecycle would expire a request on a closed one straight away
+    form.campaign_id.choices = [(c.id, f'{c.name} (${c.remaining_budget:.2f} left)')
+                                for c in Campaign.query.filter_by(sponsor_id=current_user.id)
+                                .filter(Campaign.closed_at.is_(None)).all()]
     form.influencer_id.choices = [(i.id, i.username) for i in User.query.filter_by(role='influencer').all()]
+    if request.method == 'GET':
+        # Preselect a campaign/influencer pair picked from the recommendations page
+        form.campaign_id.data = request.args.get('campaign_id', type=int)
+        form.influencer_id.data = request.args.get('influencer_id', type=int)
     if form.validate_on_submit():
         ad_request = AdRequest(
             campaign_id=form.campaign_id.data,
@@ -107,12 +156,29 @@ def create_ad_request():
             payment_amount=form.payment_amount.data,
             status=form.status.data
         )
-        db.session.add(ad_request)
-        db.session.commit()
+        try:
+            with transaction():
+                adjust(ad_request.campaign_id, committed(ad_request.status, ad_request.payment_amount))
+                db.session.add(ad_request)
+        except BudgetExceeded:
+            flash('The payment amount is more than the campaign has left in its budget.', 'danger')
+            return render_template('sponsor/create_ad_request.html', form=form)
+        events.ad_request_changed(ad_request.id, ad_request.status, ad_request.influencer_id, current_user.id)
         flash('Your ad request has been created!', 'success')
         return redirect(url_for('sponsor.dashboard'))
     return render_template('sponsor/create_ad_request.html', form=form)
 
+@sponsor_bp.route('/campaign/<int:campaign_id>/recommendations')
+@login_required
+def campaign_recommendations(campaign_id):
+    campaign = Campaign.query.get_or_404(campaign_id)
+    if campaign.sponsor_id != current_user.id:
+        flash('You are not authorized to view this campaign.', 'danger')
+        return redirect(url_for('sponsor.dashboard'))
+
+    recommendations = recommended_influencers(campaign_id)
+    return render_template('sponsor/campaign_recommendations.html', campaign=campaign, recommendations=recommendations)
+
 @sponsor_bp.route('/view_ad_request/<int:ad_request_id>')
 @login_required
 def view_ad_request(ad_request_id):
@@ -124,29 +190,57 @@ def view_ad_request(ad_request_id):
 @login_required
 def edit_ad_request(ad_request_id):
     ad_request = AdRequest.query.get_or_404(ad_request_id)
+
+    if ad_request.status == EXPIRED:
+        flash('This ad request expired when its campaign ended.', 'danger')
+        return redirect(url_for('sponsor.dashboard'))
+
     form = AdRequestForm()
 
-    # Set choices for campaigns and influencers as before
-    form.campaign_id.choices = [(c.id, c.name) for c in Campaign.query.filter_by(sponsor_id=current_user.id).all()]
+    # Set choices for campaigns and influencers as before; only running campaigns, as in create_ad_request
+    form.campaign_id.choices = [(c.id, c.name) for c in Campaign.query.filter_by(sponsor_id=current_user.id)
+                                .filter(Campaign.closed_at.is_(None)).all()]
     form.influencer_id.choices = [(i.id, i.username) for i in User.query.filter_by(role='influencer').all()]
 
     if form.validate_on_submit():
         # Update the ad request details
-        ad_request.campaign_id = form.campaign_id.data
-        ad_request.influencer_id = form.influencer_id.data
-        ad_request.messages = form.messages.data
-        ad_request.requirements = form.requirements.data
-        ad_request.payment_amount = form.payment_amount.data
+        values = dict(campaign_id=form.campaign_id.data, influencer_id=form.influencer_id.data,
+                      messages=form.messages.data, requirements=form.requirements.data,
+                      payment_amount=form.payment_amount.data)
 
         # Check for status change (e.g., negotiation)
         if ad_request.status == 'Pending' and form.status.data == 'Negotiating':
-            ad_request.status = 'Negotiating'
+            values['status'] = 'Negotiating'
         elif form.status.data == 'Accepted':
-            ad_request.status = 'Accepted'
+            values['status'] = 'Accepted'
         elif form.status.data == 'Rejected':
-            ad_request.status = 'Rejected'
+            values['status'] = 'Rejected'
+
+        # Only ad requests on the sponsor's own campaigns that have not expired meanwhile,
+        # checked in the UPDATEs themselves
+        own_campaigns = select(Campaign.id).where(Campaign.sponsor_id == current_user.id)
+        owned = AdRequest.campaign_id.in_(own_campaigns) & (AdRequest.status != EXPIRED)
+        try:
+            with transaction():
+                # The ledger reads what the request holds inside its UPDATEs, and the row is then
+                # written with exactly the values it was settled for, whatever changed meanwhile
+                updated = rewrite(ad_request_id, values['payment_amount'], values.get('status'),
+                                  values['campaign_id'], owner_clause=owned)
+                if updated:
+                    update_owned(AdRequest, ad_request_id, owned, **values)
+        except BudgetExceeded:
+            flash('The payment amount is more than the campaign has left in its budget.', 'danger')
+            return render_template('sponsor/edit_ad_request.html', form=form)
+
+        if not updated and ad_request.status == EXPIRED:
+            flash('This ad request expired when its campaign ended.', 'danger')
+            return redirect(url_for('sponsor.dashboard'))
+        if not updated:
+            flash('You are not authorized to edit this ad request.', 'danger')
+            return redirect(url_for('sponsor.dashboard'))
 
-        db.session.commit()
+        events.ad_request_changed(ad_request.id, ad_request.status, ad_request.influencer_id,
+                                  ad_request.campaign.sponsor_id)
         flash('Ad request updated!', 'success')
         return redirect(url_for('sponsor.dashboard'))
 
@@ -165,21 +259,36 @@ def edit_ad_request(ad_request_id):
 @sponsor_bp.route('/delete_ad_request/<int:ad_request_id>', methods=['POST'])
 @login_required
 def delete_ad_request(ad_request_id):
-    ad_request = AdRequest.query.get_or_404(ad_request_id)
-    db.session.delete(ad_request)
-    db.session.commit() 
+    # Only ad requests on the sponsor's own campaigns, checked in the DELETE itself
+    own_campaigns = select(Campaign.id).where(Campaign.sponsor_id == current_user.id)
+    with transaction():
+        deleted = delete_owned(AdRequest, ad_request_id, AdRequest.campaign_id.in_(own_campaigns),
+                               returning=(AdRequest.campaign_id, AdRequest.status, AdRequest.payment_amount))
+        if deleted:
+            adjust(deleted.campaign_id, -committed(deleted.status, deleted.payment_amount))
+
+    if not deleted:
+        get_or_404(AdRequest, ad_request_id)
+        flash('You are not authorized to delete this ad request.', 'danger')
+        return redirect(url_for('sponsor.dashboard'))
+
     flash('Your ad request has been deleted!', 'success')
     return redirect(url_for('sponsor.dashboard'))
 
 @sponsor_bp.route('/view_all_influencers')
+@cached_page('influencers')
+@read_only
 def view_all_influencers():
     # Fetch all users with the role of 'influencer' and their associated profile details
-    influencers = User.query.filter_by(role='influencer').all()
-    
+    influencers = User.query.options(joinedload(User.influencer_profile)).filter_by(role='influencer').all()
+    profiles = [influencer.influencer_profile for influencer in influencers]
+
     # Return both user details and the corresponding influencer profiles
-    return render_template('sponsor/view_all_influencers.html', influencers=influencers)
+    return stream_page('sponsor/view_all_influencers.html', (influencers, profiles), influencers=influencers)
 
 @sponsor_bp.route('/influencer/<int:user_id>')
+@cached_page('influencer:*', 'influencer:{user_id}')
+@read_only
 def view_influencer_profile(user_id):
     influencer = User.query.get_or_404(user_id)
     return render_template('sponsor/view_influencer_profile.html', influencer=influencer)
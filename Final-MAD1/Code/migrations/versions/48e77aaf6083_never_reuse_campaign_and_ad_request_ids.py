@@ -0,0 +1,42 @@
+"""never reuse campaign and ad request ids
+
+Revision ID: 48e77aaf6083
+Revises: baa2c103aa16
+Create Date: 2026-10-19 13:42:40.887309
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '48e77aaf6083'
+down_revision = 'baa2c103aa16'
+branch_labels = None
+depends_on = None
+
+
+# Live table -> archive table holding the ids it must never hand out again
+TABLES = {'campaign': 'archived_campaign', 'ad_request': 'archived_ad_request'}
+
+
+def upgrade():
+    # Without AUTOINCREMENT SQLite reuses the id of the highest deleted row, which may
+    # already be in the archive; other databases never reuse sequence values anyway
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table, archive in TABLES.items():
+        with op.batch_alter_table(table, recreate='always', table_kwargs={'sqlite_autoincrement': True}):
+            pass
+        op.execute(f"DELETE FROM sqlite_sequence WHERE name = '{table}'")
+        op.execute(f"INSERT INTO sqlite_sequence (name, seq) SELECT '{table}', max("
+                   f"coalesce((SELECT max(id) FROM {table}), 0), coalesce((SELECT max(id) FROM {archive}), 0))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table in TABLES:
+        with op.batch_alter_table(table, recreate='always', table_kwargs={'sqlite_autoincrement': False}):
+            pass
+        op.execute(f"DELETE FROM sqlite_sequence WHERE name = '{table}'")